@@ -1,13 +1,35 @@
 # app.py
-from flask import Flask, Response, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, has_request_context
 import requests
-from bs4 import BeautifulSoup, Tag
-from urllib.parse import urlparse, urljoin, quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from bs4 import BeautifulSoup
+from lxml import etree
+from urllib.parse import urlparse, urljoin, quote, unquote, parse_qsl, urlencode
 import os
+import re
 import hashlib
+import itertools
 import json
 import time
+from html import escape
 import gzip
+import zlib
+import sqlite3
+import struct
+import threading
+import signal
+import multiprocessing
+import tempfile
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
 from pathlib import Path
 
 app = Flask(__name__)
@@ -17,6 +39,24 @@ USER_AGENT = os.getenv(
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0"
 )
 
+# upstream HTTP client (one keep-alive connection pool per Miraheze host)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("MIRAGE_UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("MIRAGE_UPSTREAM_READ_TIMEOUT", "15"))
+UPSTREAM_POOL_HOSTS = int(os.getenv("MIRAGE_UPSTREAM_POOL_HOSTS", "32"))  # hosts with a pool kept open
+UPSTREAM_POOL_SIZE = int(os.getenv("MIRAGE_UPSTREAM_POOL_SIZE", "16"))  # keep-alive connections per host
+UPSTREAM_RETRIES = int(os.getenv("MIRAGE_UPSTREAM_RETRIES", "2"))  # after a connect error or 502/503/504, never a read timeout
+UPSTREAM_BACKOFF = float(os.getenv("MIRAGE_UPSTREAM_BACKOFF", "0.3"))  # seconds, doubled per retry
+FETCH_MODE = os.getenv("MIRAGE_FETCH_MODE", "scrape").strip().lower()  # scrape (skinned page) or api (action=parse)
+PASSTHROUGH_MAX = int(os.getenv("MIRAGE_PASSTHROUGH_MAX", str(100 * 1024 * 1024)))  # largest non-HTML file relayed, 0 = no limit
+PASSTHROUGH_CHUNK = 64 * 1024
+MEDIA_PROXY = os.getenv("MIRAGE_MEDIA_PROXY", "1").strip().lower() in ("1", "true", "yes", "on")  # serve page images through /media/
+MEDIA_CACHE_MAX = int(os.getenv("MIRAGE_MEDIA_CACHE_MAX", str(256 * 1024 * 1024)))  # 256MB of images on disk, 0 relays without caching
+MEDIA_TTL = int(os.getenv("MIRAGE_MEDIA_TTL", str(7 * 24 * 3600)))  # revalidate cached images after 7 days
+TITLE_INDEX_MAX = int(os.getenv("MIRAGE_TITLE_INDEX_MAX", "200000"))  # titles per wiki; larger wikis are searched upstream, 0 disables
+TITLE_INDEX_WIKIS = int(os.getenv("MIRAGE_TITLE_INDEX_WIKIS", "16"))  # wikis indexed per worker, least recently searched dropped first
+TITLE_INDEX_REFRESH = int(os.getenv("MIRAGE_TITLE_INDEX_REFRESH", "300"))  # seconds between recent-changes updates of an index
+TITLE_INDEX_RATE = float(os.getenv("MIRAGE_TITLE_INDEX_RATE", "2"))  # API requests per second for building and updating indexes, per worker
+
 # --- CSS (responsive, gentle light mode, gallery, vertical controls, search panel) ---
 INJECT_CSS = r"""
 :root {
@@ -436,11 +476,54 @@ INJECT_JS = r"""
 })();
 """
 
+# ---- injected assets, served from content-hashed URLs ----
+# Pages reference these instead of inlining them, so browsers fetch them once and
+# cache entries don't each carry a copy. The hash in the name changes whenever the
+# CSS/JS does, which lets them be cached "forever".
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def _build_asset(text, ext, content_type):
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    return f"mirage-{digest}.{ext}", {
+        "data": data,
+        "gzip": gzip.compress(data, compresslevel=9, mtime=0),
+        "etag": digest,
+        "content_type": content_type,
+    }
+
+_CSS_NAME, _CSS_ASSET = _build_asset(INJECT_CSS, "css", "text/css; charset=utf-8")
+_JS_NAME, _JS_ASSET = _build_asset(INJECT_JS, "js", "application/javascript; charset=utf-8")
+ASSETS = {_CSS_NAME: _CSS_ASSET, _JS_NAME: _JS_ASSET}
+CSS_URL = f"/assets/{_CSS_NAME}"
+JS_URL = f"/assets/{_JS_NAME}"
+
 CACHE_DIR = os.getenv("MIRAGE_CACHE_DIR", "./cache")
 MAX_CACHE_BYTES = int(os.getenv("MIRAGE_CACHE_MAX", str(40 * 1024 * 1024)))  # 40MB default
+RAW_CACHE_MAX = int(os.getenv("MIRAGE_CACHE_RAW_MAX", str(100 * 1024 * 1024)))  # upstream copies pages are rendered from, on top of MIRAGE_CACHE_MAX; 0 keeps none
 CACHE_TTL = int(os.getenv("MIRAGE_CACHE_TTL", str(7 * 24 * 3600)))  # 7 days default
-_META_FILENAME = "meta.json"
+MEMCACHE_MAX_BYTES = int(os.getenv("MIRAGE_MEMCACHE_MAX", str(8 * 1024 * 1024)))  # 8MB per worker, 0 disables
+MEMCACHE_TTL = int(os.getenv("MIRAGE_MEMCACHE_TTL", str(300)))  # 5 minutes default
+CACHE_STALE = int(os.getenv("MIRAGE_CACHE_STALE", str(24 * 3600)))  # serve expired pages while refreshing, 1 day default
+CACHE_STALE_IF_ERROR = int(os.getenv("MIRAGE_CACHE_STALE_IF_ERROR", str(7 * 24 * 3600)))  # serve expired pages when upstream fails
+CACHE_MAX_STALE = max(CACHE_STALE, CACHE_STALE_IF_ERROR)  # expired entries are kept on disk this long
+REFRESH_WORKERS = int(os.getenv("MIRAGE_REFRESH_WORKERS", "2"))  # background refresh threads per worker
+NEGATIVE_TTL_4XX = int(os.getenv("MIRAGE_NEGATIVE_TTL_4XX", str(600)))  # 404 / 410 from upstream
+NEGATIVE_TTL_5XX = int(os.getenv("MIRAGE_NEGATIVE_TTL_5XX", str(30)))  # upstream 5xx, timeouts, connection errors
+NEGATIVE_TTL_NO_CONTENT = int(os.getenv("MIRAGE_NEGATIVE_TTL_NO_CONTENT", str(600)))  # page had no content to extract
+NEGATIVE_CACHE_MAX = int(os.getenv("MIRAGE_NEGATIVE_CACHE_MAX", str(10000)))  # entries, kept apart from page budget
+CASE_SENSITIVE_WIKIS = {w.strip().lower() for w in os.getenv("MIRAGE_CASE_SENSITIVE_WIKIS", "").split(",") if w.strip()}  # wikis with $wgCapitalLinks = false
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("MIRAGE_SINGLE_FLIGHT_TIMEOUT", "20"))  # max wait on another request's fetch
+TRANSFORM_WORKERS = int(os.getenv("MIRAGE_TRANSFORM_WORKERS", "0"))  # page-rendering processes per worker, 0 renders on the request thread
+TRANSFORM_QUEUE = int(os.getenv("MIRAGE_TRANSFORM_QUEUE", "8"))  # pages queued or rendering in the pool before new ones get a 503
+TRANSFORM_CPU_BUDGET = float(os.getenv("MIRAGE_TRANSFORM_CPU_BUDGET", "10"))  # CPU seconds a pooled render may take, 0 = unlimited
+EARLY_FLUSH = os.getenv("MIRAGE_EARLY_FLUSH", "0").strip().lower() in ("1", "true", "yes", "on")  # stream the page shell on cache misses
+_INDEX_FILENAME = "index.sqlite3"
+_LEGACY_META_FILENAME = "meta.json"
 _MIRAGE_CACHE_KEY = os.getenv("MIRAGE_CACHE_KEY", "").strip()
+CACHE_CODEC = os.getenv("MIRAGE_CACHE_CODEC", "gzip:6").strip().lower()  # gzip[:level], zlib[:level], br[:level], zstd[:level], none
+CACHE_ZSTD_DICT = os.getenv("MIRAGE_CACHE_ZSTD_DICT", "").strip()  # optional dictionary trained on cached pages
+CUSTOM_HOSTS_FILE = os.getenv("MIRAGE_CUSTOM_HOSTS_FILE", "").strip()  # "<subdomain> <custom host>" per line
 
 
 try:
@@ -467,821 +550,3116 @@ if _MIRAGE_CACHE_KEY:
 else:
     FERNET = None
 
-# ---- file-cache helpers (encrypted when FERNET != None) ----
-def _ensure_cache_dir():
+try:
+    import zstandard
+    _ZSTD_AVAILABLE = True
+except Exception:
+    zstandard = None
+    _ZSTD_AVAILABLE = False
+
+try:
+    import brotli
+    _BROTLI_AVAILABLE = True
+except Exception:
+    brotli = None
+    _BROTLI_AVAILABLE = False
+
+# ---- cache entry encoding ----
+# Entries are compressed first and then (optionally) encrypted. Each file starts
+# with a small header: b"MRG", format version, codec id, flags. Files without the
+# header are entries from older releases (raw Fernet token or plain gzip).
+# Compressed payloads are kept as-is after decryption so that they can be sent to
+# clients with a matching Content-Encoding without recompressing anything.
+_ENTRY_MAGIC = b"MRG"
+_ENTRY_VERSION = 1
+_ENTRY_FLAG_ENCRYPTED = 0x01
+
+def _load_zstd_dict(path):
+    """
+    The zstd dictionary from MIRAGE_CACHE_ZSTD_DICT, checked with a round trip, or
+    None (with a warning) when it can't be used, so zstd runs without one rather than
+    every cache write failing.
+    """
+    if not path or not _ZSTD_AVAILABLE:
+        return None
+    try:
+        with open(path, "rb") as f:
+            zdict = zstandard.ZstdCompressionDict(f.read())
+        sample = b"<p>Mirage</p>" * 8
+        compressed = zstandard.ZstdCompressor(dict_data=zdict).compress(sample)
+        if zstandard.ZstdDecompressor(dict_data=zdict).decompress(compressed) != sample:
+            raise ValueError("round trip mismatch")
+    except Exception as e:
+        app.logger.warning("could not use MIRAGE_CACHE_ZSTD_DICT %s (%s); zstd runs without a dictionary", path, e)
+        return None
+    return zdict
+
+ZSTD_DICT = _load_zstd_dict(CACHE_ZSTD_DICT)
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level, dict_data=ZSTD_DICT).compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor(dict_data=ZSTD_DICT).decompress(data)
+
+# name -> (id, default level, compress(data, level), decompress(data))
+_CODECS = {
+    "none": (0, 0, lambda data, level: data, lambda data: data),
+    "gzip": (1, 6, lambda data, level: gzip.compress(data, compresslevel=level, mtime=0), gzip.decompress),
+    "zlib": (2, 6, lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "zstd": (3, 9, _zstd_compress, _zstd_decompress),
+    "br": (4, 9, lambda data, level: brotli.compress(data, quality=level), lambda data: brotli.decompress(data)),
+}
+_CODEC_NAMES = {spec[0]: name for name, spec in _CODECS.items()}
+
+# codec -> HTTP content-coding a client may receive the stored payload as
+_CONTENT_CODINGS = {"gzip": "gzip", "zlib": "deflate", "br": "br", "zstd": "zstd"}
+
+def _parse_codec(value):
+    name, _, level = value.partition(":")
+    if (name not in _CODECS or (name == "zstd" and not _ZSTD_AVAILABLE)
+            or (name == "br" and not _BROTLI_AVAILABLE)):
+        # unknown codec or optional package not installed -> gzip
+        name, level = "gzip", ""
+    try:
+        return name, int(level) if level else _CODECS[name][1]
+    except ValueError:
+        return name, _CODECS[name][1]
+
+_CODEC_NAME, _CODEC_LEVEL = _parse_codec(CACHE_CODEC)
+
+def compress_body(body):
+    """
+    Compress a body with the configured codec; returns (codec, payload).
+    """
+    return _CODEC_NAME, _CODECS[_CODEC_NAME][2](body, _CODEC_LEVEL)
+
+def decompress_payload(codec, payload):
+    return _CODECS[codec][3](payload)
+
+def pack_entry(codec, payload):
+    """
+    Build the on-disk entry for a compressed payload, encrypting it when FERNET is set.
+    """
+    flags = 0
+    if FERNET is not None:
+        payload = FERNET.encrypt(payload)
+        flags |= _ENTRY_FLAG_ENCRYPTED
+    return _ENTRY_MAGIC + bytes((_ENTRY_VERSION, _CODECS[codec][0], flags)) + payload
+
+def unpack_entry(blob):
+    """
+    Inverse of pack_entry(); also reads pre-header entries. Returns (codec, payload)
+    with the payload decrypted but still compressed. Raises on unreadable data.
+    """
+    if not blob.startswith(_ENTRY_MAGIC):
+        if FERNET is not None:
+            return "none", FERNET.decrypt(blob)
+        return "gzip", blob
+    version, codec_id, flags = blob[3], blob[4], blob[5]
+    if version != _ENTRY_VERSION or codec_id not in _CODEC_NAMES:
+        raise ValueError("unsupported cache entry format")
+    codec = _CODEC_NAMES[codec_id]
+    if (codec == "zstd" and not _ZSTD_AVAILABLE) or (codec == "br" and not _BROTLI_AVAILABLE):
+        raise ValueError(f"{codec} cache entry but the package is not installed")
+    payload = blob[6:]
+    if flags & _ENTRY_FLAG_ENCRYPTED:
+        if FERNET is None:
+            raise ValueError("encrypted cache entry but no MIRAGE_CACHE_KEY")
+        payload = FERNET.decrypt(payload)
+    return codec, payload
+
+def encode_entry(body):
+    """
+    Compress (with the configured codec) and then encrypt (when FERNET is set) a body.
+    """
+    return pack_entry(*compress_body(body))
+
+def decode_entry(blob):
+    """
+    Inverse of encode_entry(). Raises on unreadable data.
+    """
+    return decompress_payload(*unpack_entry(blob))
+
+# ---- cache index (SQLite in WAL mode) ----
+# One row per cache file. The running byte total lives in a single-row table kept
+# up to date by triggers, so accounting never has to scan the whole index, and
+# eviction walks the atime index from the oldest entry. Upstream documents (`raw`
+# rows) are also totalled on their own, as they have a budget of their own.
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    fname TEXT PRIMARY KEY,
+    key TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    atime REAL NOT NULL,
+    upstream TEXT,
+    raw INTEGER NOT NULL DEFAULT 0,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, size) VALUES (0, 0);
+CREATE TABLE IF NOT EXISTS raw_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO raw_totals (id, size) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_after_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET size = size + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_after_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_after_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size + NEW.size WHERE id = 0;
+END;
+CREATE TABLE IF NOT EXISTS negative (
+    key_hash TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS negative_expires ON negative (expires);
+CREATE TABLE IF NOT EXISTS key_aliases (
+    raw_hash TEXT PRIMARY KEY,
+    key_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS custom_hosts (
+    subdomain TEXT PRIMARY KEY,
+    host TEXT NOT NULL UNIQUE,
+    seeded INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flights (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media (
+    fname TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_atime ON media (atime);
+CREATE TABLE IF NOT EXISTS media_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO media_totals (id, size) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS media_after_insert AFTER INSERT ON media BEGIN
+    UPDATE media_totals SET size = size + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS media_after_delete AFTER DELETE ON media BEGIN
+    UPDATE media_totals SET size = size - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS media_after_update AFTER UPDATE OF size ON media BEGIN
+    UPDATE media_totals SET size = size - OLD.size + NEW.size WHERE id = 0;
+END;
+"""
+
+_index_local = threading.local()
+_swept_pid = None
+_STALE_TEMP_AGE = 3600  # a temp file left this long belongs to a writer that died
+
+def _index_path():
+    return os.path.join(CACHE_DIR, _INDEX_FILENAME)
+
+def _open_index():
+    path = _index_path()
+    existed = os.path.exists(path)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
     try:
-        Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
-        meta_path = _meta_path()
-        if not os.path.exists(meta_path):
-            with open(meta_path, "w", encoding="utf-8") as f:
-                json.dump({}, f)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_INDEX_SCHEMA)
+        _migrate_index(conn)
+        _seed_custom_hosts(conn)
     except Exception:
-        return
+        conn.close()
+        raise
+    if not existed:
+        _rebuild_index(conn)
+    global _swept_pid
+    if _swept_pid != os.getpid():
+        _swept_pid = os.getpid()
+        _sweep_stale_temp_files()
+    return conn
+
+# needs the columns _migrate_index() adds to older indexes
+_RAW_SCHEMA = """
+CREATE INDEX IF NOT EXISTS entries_raw_atime ON entries (raw, atime);
+CREATE TRIGGER IF NOT EXISTS raw_after_insert AFTER INSERT ON entries BEGIN
+    UPDATE raw_totals SET size = size + NEW.raw * NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS raw_after_delete AFTER DELETE ON entries BEGIN
+    UPDATE raw_totals SET size = size - OLD.raw * OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS raw_after_update AFTER UPDATE OF size, raw ON entries BEGIN
+    UPDATE raw_totals SET size = size - OLD.raw * OLD.size + NEW.raw * NEW.size WHERE id = 0;
+END;
+"""
+
+def _migrate_index(conn):
+    # columns added after the first index release
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+    if "upstream" not in columns:
+        try:
+            conn.execute("ALTER TABLE entries ADD COLUMN upstream TEXT")
+        except sqlite3.OperationalError:
+            pass  # another worker added it first
+    if "raw" not in columns:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if "raw" not in {row[1] for row in conn.execute("PRAGMA table_info(entries)")}:
+                conn.execute("ALTER TABLE entries ADD COLUMN raw INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE entries ADD COLUMN source TEXT")
+                conn.execute("UPDATE entries SET raw = 1 WHERE key LIKE 'raw|%'")
+                conn.execute("UPDATE raw_totals SET size = (SELECT COALESCE(SUM(size), 0) FROM entries WHERE raw = 1)")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    conn.executescript(_RAW_SCHEMA)
+
+def _discard_index():
+    # drop an unreadable index (and its WAL files) so the next open rebuilds it
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(_index_path() + suffix)
+        except Exception:
+            pass
+
+def _index():
+    """
+    Return this thread's connection to the cache index, opening it on first use.
+    Connections are per-thread and per-process (gunicorn forks after import).
+    """
+    conn = getattr(_index_local, "conn", None)
+    if conn is not None and getattr(_index_local, "pid", None) == os.getpid():
+        return conn
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    try:
+        conn = _open_index()
+    except sqlite3.DatabaseError:
+        # corrupt index -> throw it away and rebuild from the files on disk
+        _discard_index()
+        conn = _open_index()
+    _index_local.conn = conn
+    _index_local.pid = os.getpid()
+    return conn
+
+def _sweep_stale_temp_files():
+    """
+    Delete the temp files of writes that never finished (a worker killed while it
+    wrote or waited for the index lock). They aren't indexed, so nothing else
+    would ever remove them or count them against the budget.
+    """
+    cutoff = time.time() - _STALE_TEMP_AGE
+    for directory in (CACHE_DIR, _media_dir()):
+        try:
+            with os.scandir(directory) as it:
+                stale = [de.path for de in it
+                         if de.name.endswith(".tmp") and de.is_file() and de.stat().st_mtime < cutoff]
+        except Exception:
+            continue
+        for path in stale:
+            try:
+                os.remove(path)
+            except Exception:
+                pass
 
-def _meta_path():
-    return os.path.join(CACHE_DIR, _META_FILENAME)
+def _scan_entry_files(directory):
+    # (name, size, mtime) of the cache files in directory
+    found = []
+    with os.scandir(directory) as it:
+        for de in it:
+            if not de.name.endswith(".bin") or not de.is_file():
+                continue
+            try:
+                st = de.stat()
+            except Exception:
+                continue
+            found.append((de.name, st.st_size, st.st_mtime))
+    return found
 
-def _load_meta():
+def _rebuild_index(conn):
+    """
+    Recreate index rows by scanning CACHE_DIR and its media directory. Used when the
+    index file is missing (first start, lost volume, or upgrade from the old meta.json index).
+    """
     try:
-        p = _meta_path()
-        if not os.path.exists(p):
-            return {}
-        with open(p, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
+        rows = [(name, None, size, mtime, mtime) for name, size, mtime in _scan_entry_files(CACHE_DIR)]
     except Exception:
-        return {}
+        return
+    try:
+        media_rows = [(name, size, mtime) for name, size, mtime in _scan_entry_files(_media_dir())]
+    except Exception:
+        media_rows = []
+    legacy = os.path.join(CACHE_DIR, _LEGACY_META_FILENAME)
+    try:
+        with open(legacy, "r", encoding="utf-8") as f:
+            meta = json.load(f) or {}
+        rows = [(fname, meta.get(fname, {}).get("key"), size, mtime, meta.get(fname, {}).get("atime", atime))
+                for fname, _key, size, mtime, atime in rows]
+    except Exception:
+        pass
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO entries (fname, key, size, mtime, atime) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (fname) DO NOTHING",
+            rows,
+        )
+        conn.executemany(
+            "INSERT INTO media (fname, size, atime) VALUES (?, ?, ?) ON CONFLICT (fname) DO NOTHING",
+            media_rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        os.remove(legacy)
+    except Exception:
+        pass
+
+def _index_total(conn):
+    # bytes of rendered pages
+    row = conn.execute("SELECT size FROM totals WHERE id = 0").fetchone()
+    return (row[0] if row else 0) - _raw_total(conn)
 
-def _save_meta(meta):
+def _raw_total(conn):
+    # bytes of upstream documents
+    row = conn.execute("SELECT size FROM raw_totals WHERE id = 0").fetchone()
+    return row[0] if row else 0
+
+@contextmanager
+def _index_transaction():
+    """
+    Hold the index write lock for the duration of the block. SQLite serialises
+    BEGIN IMMEDIATE across threads and gunicorn workers, so replacing or deleting
+    a cache file and the matching index update happen as one step.
+    """
+    conn = _index()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _index_forget(fname):
+    # drop a row whose file has vanished, unless another worker has just rewritten it
     try:
-        p = _meta_path()
-        tmp = p + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(meta, f)
-        os.replace(tmp, p)
+        if _index().execute("SELECT 1 FROM entries WHERE fname = ?", (fname,)).fetchone() is None:
+            return
+        with _index_transaction() as conn:
+            if not os.path.exists(os.path.join(CACHE_DIR, fname)):
+                conn.execute("DELETE FROM entries WHERE fname = ?", (fname,))
     except Exception:
         pass
 
+# payload is the (decrypted) compressed body as stored, codec the _CODECS name;
+# mtime drives the TTL (backdated for pages rendered from an older upstream copy),
+# written is when this body was actually stored
+CacheHit = namedtuple("CacheHit", ["payload", "codec", "mtime", "written"])
+
+def _written(stat):
+    # a backdated file's ctime still records when it was written (or last renewed)
+    return max(stat.st_mtime, stat.st_ctime)
+
+def is_fresh(hit):
+    return (time.time() - hit.mtime) <= CACHE_TTL
+
+def hit_body(hit):
+    return decompress_payload(hit.codec, hit.payload)
+
+def hit_content_coding(hit):
+    # zstd payloads made with our private dictionary can't be decoded by browsers
+    if hit.codec == "zstd" and ZSTD_DICT is not None:
+        return None
+    return _CONTENT_CODINGS.get(hit.codec)
+
+# ---- in-process memory tier (ready-to-send bodies, in front of the file cache) ----
+class _MemoryCache:
+    """
+    Byte-bounded LRU of CacheHits (compressed, decrypted response bodies), keyed
+    like the file cache.
+    Each entry remembers the mtime of the file-cache entry it came from so it
+    expires (and goes stale) at exactly the same moment the disk copy would;
+    MEMCACHE_TTL further bounds how long a worker may serve its copy without
+    looking at the disk.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, max_stale=0):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            hit, stored = entry
+            if (now - stored) > self.ttl or (now - hit.mtime) > CACHE_TTL + CACHE_MAX_STALE:
+                self._drop(key)
+                return None
+            if (now - hit.mtime) > CACHE_TTL + max_stale:
+                return None
+            self._entries.move_to_end(key)
+            return hit
+
+    def set(self, key, hit):
+        # don't let a single huge page flush the whole tier
+        if self.max_bytes <= 0 or len(hit.payload) > self.max_bytes // 8:
+            self.discard(key)
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (hit, time.time())
+            self._size += len(hit.payload)
+            while self._size > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0].payload)
+
+MEMCACHE = _MemoryCache(MEMCACHE_MAX_BYTES, MEMCACHE_TTL)
+
+# ---- file-cache helpers ----
 def _key_to_filename(key: str) -> str:
     h = hashlib.sha256(key.encode("utf-8")).hexdigest()
     return f"{h}.bin"
 
-def _prune_cache_if_needed(meta):
+def _delete_entry(conn, fname):
+    # caller holds the index write lock
     try:
-        total = sum(v.get("size", 0) for v in meta.values())
-        if total <= MAX_CACHE_BYTES:
-            return meta
-        items = sorted(meta.items(), key=lambda kv: kv[1].get("atime", 0))
-        for fname, info in items:
-            fpath = os.path.join(CACHE_DIR, fname)
-            try:
-                if os.path.exists(fpath):
-                    os.remove(fpath)
-            except Exception:
-                pass
-            total -= info.get("size", 0)
-            meta.pop(fname, None)
-            if total <= MAX_CACHE_BYTES:
-                break
-        _save_meta(meta)
+        os.remove(os.path.join(CACHE_DIR, fname))
+    except FileNotFoundError:
+        pass
+    conn.execute("DELETE FROM entries WHERE fname = ?", (fname,))
+
+def _remove_cache_file(fname):
+    try:
+        with _index_transaction() as conn:
+            _delete_entry(conn, fname)
     except Exception:
         pass
-    return meta
+
+def _prune_cache_if_needed(conn, keep=None, raw=False):
+    """
+    Evict least-recently-used entries until the indexed total fits MAX_CACHE_BYTES
+    (upstream documents, with `raw`: RAW_CACHE_MAX).
+    Must run inside _index_transaction(); `keep` is the entry being written.
+    """
+    budget = RAW_CACHE_MAX if raw else MAX_CACHE_BYTES
+    total = _raw_total(conn) if raw else _index_total(conn)
+    while total > budget:
+        victims = conn.execute(
+            "SELECT fname, size FROM entries WHERE raw = ? AND fname != ? ORDER BY atime LIMIT 32",
+            (int(raw), keep or ""),
+        ).fetchall()
+        if not victims:
+            break
+        for fname, size in victims:
+            _delete_entry(conn, fname)
+            total -= size
+            if total <= budget:
+                break
 
 def cache_get(key: str):
     """
-    Return cached HTML string if valid and not expired, otherwise None.
-    Encrypted files are decrypted using FERNET when available. Fallback uses gzip.
+    Return the cached UTF-8 HTML body (bytes) if valid and not expired, otherwise None.
     """
+    hit = cache_lookup(key)
+    return hit_body(hit) if hit is not None else None
+
+def cache_lookup(key: str, max_stale=0, memory=True):
+    """
+    Return a CacheHit(payload, codec, mtime, written) for key, or None. Entries up to `max_stale` seconds
+    past CACHE_TTL are returned too (check with is_fresh()); entries older than
+    CACHE_TTL + CACHE_MAX_STALE are deleted.
+    The memory tier is consulted first; on a miss the file is read and decrypted using
+    FERNET when available, and the still-compressed payload is promoted to memory.
+    `memory=False` leaves the memory tier out (for entries that are never sent as they are).
+    """
+    hit = MEMCACHE.get(key, max_stale) if memory else None
+    if hit is not None:
+        return hit
     try:
-        _ensure_cache_dir()
+        conn = _index()
         fname = _key_to_filename(key)
         fpath = os.path.join(CACHE_DIR, fname)
-        if not os.path.exists(fpath):
-            meta = _load_meta()
-            if fname in meta:
-                meta.pop(fname, None)
-                _save_meta(meta)
+        try:
+            stat = os.stat(fpath)
+        except FileNotFoundError:
+            _index_forget(fname)
             return None
 
-        stat = os.stat(fpath)
         now = time.time()
-        # TTL check (based on mtime)
-        if (now - stat.st_mtime) > CACHE_TTL:
-            try:
-                os.remove(fpath)
-            except Exception:
-                pass
-            meta = _load_meta()
-            if fname in meta:
-                meta.pop(fname, None)
-                _save_meta(meta)
+        # TTL check (based on mtime); expired entries linger for stale serving
+        age = now - stat.st_mtime
+        if age > CACHE_TTL + CACHE_MAX_STALE:
+            _remove_cache_file(fname)
+            return None
+        if age > CACHE_TTL + max_stale:
             return None
 
-        # read bytes
+        # read bytes (os.replace by another worker is atomic, so this is the old or new file)
         with open(fpath, "rb") as f:
             blob = f.read()
 
-        if FERNET is not None:
-            try:
-                decrypted = FERNET.decrypt(blob)
-                html = decrypted.decode("utf-8")
-            except InvalidToken:
-                # can't decrypt -> remove corrupted/unreadable cache entry
-                try:
-                    os.remove(fpath)
-                except Exception:
-                    pass
-                meta = _load_meta()
-                if fname in meta:
-                    meta.pop(fname, None)
-                    _save_meta(meta)
-                return None
-        else:
-            # fallback: gzip-compressed storage
-            try:
-                html = gzip.decompress(blob).decode("utf-8")
-            except Exception:
-                # unreadable -> remove
-                try:
-                    os.remove(fpath)
-                except Exception:
-                    pass
-                meta = _load_meta()
-                if fname in meta:
-                    meta.pop(fname, None)
-                    _save_meta(meta)
-                return None
+        try:
+            codec, payload = unpack_entry(blob)
+        except Exception:
+            # can't decrypt / decompress -> remove corrupted/unreadable cache entry
+            _remove_cache_file(fname)
+            return None
+
+        # update atime, and that of the upstream copy a rendering was made from (which is
+        # only read again after a deploy or once it expires); a row evicted meanwhile
+        # by another worker stays evicted
+        conn.execute(
+            "UPDATE entries SET atime = ? WHERE fname IN (?, (SELECT source FROM entries WHERE fname = ?))",
+            (now, fname, fname),
+        )
+        hit = CacheHit(payload, codec, stat.st_mtime, _written(stat))
+        if memory:
+            MEMCACHE.set(key, hit)
+        return hit
+    except Exception:
+        return None
+
+def cache_delete(key: str):
+    MEMCACHE.discard(key)
+    _remove_cache_file(_key_to_filename(key))
+
+def cache_validators(key: str):
+    """
+    Return the upstream validators stored with key's entry (etag, last_modified, revid, fetched).
+    """
+    try:
+        row = _index().execute(
+            "SELECT upstream FROM entries WHERE fname = ?", (_key_to_filename(key),)
+        ).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+    except Exception:
+        return {}
 
-        # update meta atime
-        meta = _load_meta()
-        entry = meta.get(fname, {})
-        entry["atime"] = now
-        entry["mtime"] = stat.st_mtime
-        entry["size"] = stat.st_size
-        entry["key"] = key
-        meta[fname] = entry
-        _save_meta(meta)
-        return html
+def cache_renew(key: str, memory=True):
+    """
+    Restart key's TTL without rewriting it (upstream said the page is unchanged).
+    Returns the renewed CacheHit, or None if the entry is gone.
+    """
+    fname = _key_to_filename(key)
+    now = time.time()
+    try:
+        with _index_transaction() as conn:
+            os.utime(os.path.join(CACHE_DIR, fname), (now, now))
+            conn.execute("UPDATE entries SET mtime = ?, atime = ? WHERE fname = ?", (now, now, fname))
     except Exception:
         return None
+    MEMCACHE.discard(key)
+    return cache_lookup(key, memory=memory)
 
-def cache_set(key: str, html: str):
+def cache_set(key: str, html: str, validators=None, mtime=None, raw=False, source=None):
     """
-    Save html under key. If FERNET is set, persist encrypted bytes; else gzip compress.
-    Returns True on success.
+    Save html under key, compressed with MIRAGE_CACHE_CODEC and then encrypted if FERNET is set.
+    `validators` (upstream ETag / Last-Modified / revision id) are kept in the index
+    so an expired entry can be revalidated instead of refetched. `mtime` backdates the
+    entry (a page rendered from an older upstream copy expires with that copy).
+    `raw` marks an upstream document: it counts against RAW_CACHE_MAX instead of
+    MAX_CACHE_BYTES and stays out of the memory tier. `source` is the key of the
+    upstream document a rendering was made from, kept in use as long as it is.
+    The file is written to a private temp file first, then moved into place while
+    holding the index write lock, after older entries have been evicted to make room,
+    so concurrent workers never push the cache past its budget.
+    Returns the stored CacheHit on success, None otherwise.
     """
+    tmp = None
     try:
-        _ensure_cache_dir()
+        conn = _index()
         fname = _key_to_filename(key)
         fpath = os.path.join(CACHE_DIR, fname)
-        tmp = fpath + ".tmp"
-
-        if FERNET is not None:
-            payload = FERNET.encrypt(html.encode("utf-8"))
-            # write bytes
-            with open(tmp, "wb") as f:
-                f.write(payload)
-        else:
-            # fallback: gzip-compress text (not encrypted)
-            blob = gzip.compress(html.encode("utf-8"))
-            with open(tmp, "wb") as f:
-                f.write(blob)
+        codec, payload = compress_body(html.encode("utf-8"))
+        blob = pack_entry(codec, payload)
+        if len(blob) > (RAW_CACHE_MAX if raw else MAX_CACHE_BYTES):
+            return None
 
-        os.replace(tmp, fpath)
-        stat = os.stat(fpath)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=fname + ".", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        stat = os.stat(tmp)
         now = time.time()
-        meta = _load_meta()
-        meta[fname] = {
-            "key": key,
-            "size": stat.st_size,
-            "mtime": stat.st_mtime,
-            "atime": now
-        }
-        meta = _prune_cache_if_needed(meta)
-        _save_meta(meta)
-        return True
+        backdated = mtime is not None
+        if not backdated:
+            mtime = stat.st_mtime
+        with _index_transaction() as conn:
+            conn.execute(
+                "INSERT INTO entries (fname, key, size, mtime, atime, upstream, raw, source) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (fname) DO UPDATE SET key = excluded.key, size = excluded.size, "
+                "mtime = excluded.mtime, atime = excluded.atime, upstream = excluded.upstream, "
+                "raw = excluded.raw, source = excluded.source",
+                (fname, key, stat.st_size, mtime, now, json.dumps(validators) if validators else None,
+                 int(raw), _key_to_filename(source) if source else None),
+            )
+            _prune_cache_if_needed(conn, keep=fname, raw=raw)
+            os.replace(tmp, fpath)
+            tmp = None
+            if backdated:
+                # only once in place: a temp file's mtime tells the sweep when it was written
+                try:
+                    os.utime(fpath, (mtime, mtime))
+                except OSError:
+                    pass
+            try:
+                written = _written(os.stat(fpath))
+            except OSError:
+                written = stat.st_mtime
+        hit = CacheHit(payload, codec, mtime, written)
+        if not raw:
+            MEMCACHE.set(key, hit)
+        return hit
     except Exception:
-        return False
+        return None
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except Exception:
+                pass
+
+# ---- custom domains ----
+# Wikis with their own domain, learned from the canonical URL of pages we fetch and
+# optionally seeded from MIRAGE_CUSTOM_HOSTS_FILE. Kept in the cache index so every
+# worker shares it: raw-subdomain redirects and upstream URLs need no extra round trip.
+def _load_custom_hosts_file(path):
+    hosts = {}
+    if not path:
+        return hosts
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                if len(fields) == 2:
+                    sub = fields[0].strip(".").lower()
+                    if sub.endswith(".miraheze.org"):
+                        sub = sub[:-len(".miraheze.org")]
+                    hosts[sub] = fields[1].strip(".").lower()
+    except Exception:
+        app.logger.warning("could not read MIRAGE_CUSTOM_HOSTS_FILE %s", path)
+    return hosts
+
+SEED_CUSTOM_HOSTS = _load_custom_hosts_file(CUSTOM_HOSTS_FILE)
+
+def _seed_custom_hosts(conn):
+    # called while opening the index, so it can't go through _index_transaction().
+    # Rows seeded earlier but no longer in the file become ordinary learned rows.
+    if not SEED_CUSTOM_HOSTS and conn.execute("SELECT 1 FROM custom_hosts WHERE seeded = 1 LIMIT 1").fetchone() is None:
+        return
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("UPDATE custom_hosts SET seeded = 0 WHERE seeded = 1")
+        conn.executemany(
+            "INSERT OR REPLACE INTO custom_hosts (subdomain, host, seeded, updated) VALUES (?, ?, 1, ?)",
+            [(sub, host, now) for sub, host in SEED_CUSTOM_HOSTS.items()],
+        )
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def custom_host_for(remote_sub):
+    """Known custom domain of a Miraheze subdomain, or None."""
+    try:
+        row = _index().execute("SELECT host FROM custom_hosts WHERE subdomain = ?", (remote_sub.lower(),)).fetchone()
+    except Exception:
+        return None
+    return row[0] if row else None
+
+def subdomain_for_host(host):
+    """Miraheze subdomain behind a custom domain, or None if we haven't seen it."""
+    try:
+        row = _index().execute("SELECT subdomain FROM custom_hosts WHERE host = ?", (host.strip(".").lower(),)).fetchone()
+    except Exception:
+        return None
+    return row[0] if row else None
+
+def remember_custom_host(remote_sub, custom_host):
+    """
+    Record what a page fetched from remote_sub said about its domain. custom_host None
+    means the wiki is served from miraheze.org, so a learned (not seeded) mapping is dropped.
+    """
+    remote_sub = remote_sub.lower()
+    try:
+        if custom_host:
+            custom_host = custom_host.lower()
+            if custom_host_for(remote_sub) == custom_host:
+                return
+            with _index_transaction() as conn:
+                # REPLACE also evicts a row that had this host under another subdomain
+                conn.execute(
+                    "INSERT OR REPLACE INTO custom_hosts (subdomain, host, seeded, updated) VALUES (?, ?, 0, ?)",
+                    (remote_sub, custom_host, time.time()),
+                )
+        elif custom_host_for(remote_sub) is not None:
+            with _index_transaction() as conn:
+                conn.execute("DELETE FROM custom_hosts WHERE subdomain = ? AND seeded = 0", (remote_sub,))
+    except Exception:
+        pass
+
+def custom_host_redirect(custom_host, path, mode, qs):
+    location = f"/{custom_host}/{ 'wiki' if mode=='wiki' else 'w' }/{path}"
+    if qs:
+        location = location + "?" + qs
+    return Response(status=302, headers={"Location": location})
 
 def derive_remote_subdomain(wiki_param: str) -> str:
-    # If wiki_param contains dot (custom host), remote subdomain is first label; else it's the wiki_param
+    # Custom host: the subdomain we learned it belongs to, else guess its first label
     if '.' in wiki_param:
+        mapped = subdomain_for_host(wiki_param)
+        if mapped:
+            return mapped
         return wiki_param.split('.')[0]
     return wiki_param
 
-def detect_custom_host_from_soup(soup: BeautifulSoup):
+def detect_custom_host(root):
     # inspect canonical and og:url meta tags for custom domain
-    c = soup.find('link', rel=lambda r: r and 'canonical' in r)
-    if c and c.get('href'):
+    c = next((link for link in root.iter("link") if "canonical" in (link.get("rel") or "")), None)
+    if c is not None and c.get('href'):
         try:
-            parsed = urlparse(c['href'])
+            parsed = urlparse(c.get('href'))
             if parsed.netloc and not parsed.netloc.endswith('.miraheze.org'):
                 return parsed.netloc
         except Exception:
             pass
-    og = soup.find('meta', property='og:url')
-    if og and og.get('content'):
+    og = next((meta for meta in root.iter("meta") if meta.get("property") == "og:url"), None)
+    if og is not None and og.get('content'):
         try:
-            parsed = urlparse(og['content'])
+            parsed = urlparse(og.get('content'))
             if parsed.netloc and not parsed.netloc.endswith('.miraheze.org'):
                 return parsed.netloc
         except Exception:
             pass
-    og2 = soup.find('meta', attrs={'name': 'og:url'}) or soup.find('meta', attrs={'name': 'twitter:url'})
-    if og2 and og2.get('content'):
+    og2 = (next((meta for meta in root.iter("meta") if meta.get("name") == "og:url"), None)
+           or next((meta for meta in root.iter("meta") if meta.get("name") == "twitter:url"), None))
+    if og2 is not None and og2.get('content'):
         try:
-            parsed = urlparse(og2['content'])
+            parsed = urlparse(og2.get('content'))
             if parsed.netloc and not parsed.netloc.endswith('.miraheze.org'):
                 return parsed.netloc
         except Exception:
             pass
     return None
 
-def fetch_remote(url):
-    headers = {"User-Agent": USER_AGENT}
-    return requests.get(url, headers=headers, timeout=15)
-
-# Rewrite links with special handling for categories and fragments
-def rewrite_links_in_tag(tag, wiki_param, remote_sub, custom_host, base_url):
-    base_parsed = urlparse(base_url)
-    base_path = base_parsed.path or ""
-    base_query = base_parsed.query or ""
-
-    def host_segment():
-        return custom_host if custom_host else remote_sub
+_upstream_local = {}
+_upstream_lock = threading.Lock()
 
-    for a in tag.find_all("a", href=True):
-        raw = (a["href"] or "").strip()
-        if not raw:
-            continue
-        if raw.startswith("javascript:") or raw.startswith("mailto:"):
-            continue
-        # fragments: keep as-is
-        if raw.startswith("#"):
-            a["href"] = raw
-            continue
-        if raw.startswith("//"):
-            a["href"] = "https:" + raw
-            continue
-        if raw.startswith("http://") or raw.startswith("https://"):
-            parsed = urlparse(raw)
-            host = parsed.netloc.lower()
-            if host.endswith(".miraheze.org"):
-                sub = host.split(".")[0]
-                seg = host_segment() if (custom_host and sub == remote_sub) else sub
-                # category path + query -> route to index.php for correct pagination
-                if parsed.path.startswith("/wiki/Category:") and parsed.query:
-                    title = parsed.path[len("/wiki/"):]
-                    new = f"/{quote(seg, safe='')}/w/index.php?title={quote(title, safe='')}"
-                    if parsed.query:
-                        new += "&" + parsed.query
-                    if parsed.fragment:
-                        new += "#" + parsed.fragment
-                    a["href"] = new
-                else:
-                    new = f"/{quote(seg, safe='')}{parsed.path}"
-                    if parsed.query:
-                        new += "?" + parsed.query
-                    if parsed.fragment:
-                        new += "#" + parsed.fragment
-                    a["href"] = new
-            else:
-                a["target"] = "_blank"
-            continue
-        if raw.startswith("/"):
-            parsed = urlparse(raw)
-            if parsed.path.startswith("/wiki/Category:") and parsed.query:
-                seg = host_segment()
-                title = parsed.path[len("/wiki/"):]
-                new = f"/{quote(seg, safe='')}/w/index.php?title={quote(title, safe='')}"
-                if parsed.query:
-                    new += "&" + parsed.query
-                if parsed.fragment:
-                    new += "#" + parsed.fragment
-                a["href"] = new
-                continue
-            seg = host_segment()
-            a["href"] = f"/{quote(seg, safe='')}{raw}"
-            continue
-        if raw.startswith("?"):
-            # if base page is a category, rewrite to index.php?title=Category:...
-            if base_path.startswith("/wiki/Category:") or ("title=Category:" in base_query):
-                if base_path.startswith("/wiki/"):
-                    title = base_path[len("/wiki/"):]
-                else:
-                    title = ""
-                    for part in base_query.split("&"):
-                        if part.startswith("title="):
-                            title = part[len("title="):]
-                            break
-                seg = host_segment()
-                if title:
-                    a["href"] = f"/{quote(seg, safe='')}/w/index.php?title={quote(title, safe='')}{raw}"
-                else:
-                    a["href"] = f"/{quote(seg, safe='')}{base_path}{raw}"
-                continue
-            seg = host_segment()
-            a["href"] = f"/{quote(seg, safe='')}{base_path}{raw}"
-            continue
-        # relative path without slash -> wiki page
-        seg = host_segment()
-        a["href"] = f"/{quote(seg, safe='')}/wiki/{quote(raw, safe='')}"
-
-# Normalize image src attributes to use absolute links where appropriate
-def normalize_images_in_tag(tag, remote_sub, base_url):
-    for img in tag.find_all("img", src=True):
-        src = (img["src"] or "").strip()
-        if src.startswith("//"):
-            img["src"] = "https:" + src
-        elif src.startswith("http://") or src.startswith("https://"):
-            pass
-        elif src.startswith("/"):
-            img["src"] = f"https://{remote_sub}.miraheze.org{src}"
+def upstream_session():
+    """
+    Shared requests.Session for all upstream traffic in this process. The
+    HTTPAdapter keeps a thread-safe keep-alive pool per host, and idempotent GETs
+    are retried with exponential backoff on connection errors and 502/503/504.
+    A read timeout is not retried: Miraheze is overloaded, waiting again would
+    outlast the gunicorn worker timeout, and stale-if-error can answer instead.
+    Cookies are never stored, so nothing set for one visitor is sent for another.
+    """
+    session = _upstream_local.get(os.getpid())
+    if session is not None:
+        return session
+    with _upstream_lock:
+        session = _upstream_local.get(os.getpid())
+        if session is None:
+            _upstream_local.clear()  # drop a session inherited across fork
+            session = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            retry = Retry(
+                total=UPSTREAM_RETRIES,
+                read=0,
+                backoff_factor=UPSTREAM_BACKOFF,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(["GET", "HEAD"]),
+                respect_retry_after_header=False,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_HOSTS, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=retry)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _upstream_local[os.getpid()] = session
+    return session
+
+def fetch_remote(url, headers=None, stream=False):
+    return upstream_session().get(
+        url, headers=headers, stream=stream, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+    )
+
+# Work that talks to Miraheze is written as generators ("upstream steps") that yield an
+# UpstreamRequest wherever they need a page and get the response sent back (or the
+# requests.RequestException thrown in). run_upstream() drives them with fetch_remote();
+# the ASGI server (asgi.py) drives the same steps with an async client. With stream set,
+# a body that isn't text/html is left unread for the steps to relay (see UpstreamBody).
+UpstreamRequest = namedtuple("UpstreamRequest", ["url", "headers", "stream"], defaults=(False,))
+UpstreamDone = namedtuple("UpstreamDone", ["value"])
+
+def advance_upstream(steps, response=None, error=None):
+    """
+    Resume steps with the response to their last request (or the error it raised).
+    Returns their next UpstreamRequest, or UpstreamDone with what they returned.
+    """
+    try:
+        if error is not None:
+            return steps.throw(error)
+        return steps.send(response)
+    except StopIteration as done:
+        return UpstreamDone(done.value)
+
+def run_upstream(steps):
+    step = advance_upstream(steps)
+    while isinstance(step, UpstreamRequest):
+        try:
+            r = fetch_remote(step.url, headers=step.headers, stream=step.stream)
+        except requests.RequestException as e:
+            step = advance_upstream(steps, error=e)
         else:
-            img["src"] = urljoin(base_url, src)
-
-# Extract categories early (from raw soup) to avoid accidental removal
-def find_categories_early(soup, wiki_param, remote_sub, custom_host):
-    selectors = [".mw-catlinks", "#catlinks", ".mw-normal-catlinks", ".catlinks", "div#catlinks", "div.mw-catlinks"]
-    for sel in selectors:
-        node = soup.select_one(sel)
-        if node:
-            anchors = node.find_all("a", href=True)
-            items = []
-            for a in anchors:
-                text = a.get_text(strip=True)
-                href = a["href"].strip()
-                if href.startswith("/wiki/"):
-                    if custom_host:
-                        link = f"/{custom_host}{href}"
-                    else:
-                        link = f"/{remote_sub}{href}"
-                elif href.startswith("http://") or href.startswith("https://"):
-                    link = href
-                else:
-                    link = href
-                items.append((text, link))
-            try:
-                node.decompose()
-            except Exception:
-                pass
-            if items:
-                return items
-    return None
+            step = advance_upstream(steps, r)
+    return step.value
+
+class RateLimit:
+    """Spaces wait() returns at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        time.sleep(slot - now)
+
+_REVISION_RE = re.compile(r'"wgRevisionId"\s*:\s*(\d+)')
+
+# ---- non-HTML passthrough ----
+# Files (images, PDFs, action=raw, load.php) are relayed as they arrive, still in their
+# upstream Content-Encoding, so a worker holds one chunk of them at a time.
+_PASSTHROUGH_HEADERS = (
+    "Content-Type", "Content-Length", "Content-Encoding", "Content-Range", "Accept-Ranges",
+    "Content-Disposition", "ETag", "Last-Modified",
+)
+_RANGE_HEADERS = ("Range", "If-Range")
+# codings the upstream clients can decode when the body turns out to be a page
+_DECODABLE_CODINGS = tuple(c.strip() for c in ACCEPT_ENCODING.split(","))
 
-def extract_categories_from_content(content_tag, wiki_param, remote_sub, custom_host):
-    for sel in [".mw-catlinks", "#catlinks", ".mw-normal-catlinks", ".catlinks"]:
-        node = content_tag.select_one(sel)
-        if node:
-            anchors = node.find_all("a", href=True)
-            items = []
-            for a in anchors:
-                text = a.get_text(strip=True)
-                href = a["href"].strip()
-                if href.startswith("/wiki/"):
-                    if custom_host:
-                        link = f"/{custom_host}{href}"
-                    else:
-                        link = f"/{remote_sub}{href}"
-                elif href.startswith("http://") or href.startswith("https://"):
-                    link = href
-                else:
-                    link = href
-                items.append((text, link))
-            try:
-                node.decompose()
-            except Exception:
-                pass
-            if items:
-                return items
-    return None
+def upstream_accept_encoding():
+    """
+    Accept-Encoding for a fetch that may be relayed untouched: the reader's codings
+    that we can decode too, or identity (readers sending no Accept-Encoding, like
+    curl without --compressed, get the plain file as before).
+    """
+    if not has_request_context():
+        return ", ".join(_DECODABLE_CODINGS)
+    return ", ".join(c for c in _DECODABLE_CODINGS if request.accept_encodings[c]) or "identity"
 
-# Remove global unwanteds (scripts, style, cookie banners, vector class, headers/footers)
-def remove_unwanted_global(soup):
-    for tag in list(soup.find_all(["script", "style"])):
-        try:
-            tag.decompose()
-        except Exception:
-            pass
-    for link in list(soup.find_all("link", rel=True)):
+class UpstreamBody:
+    """
+    WSGI body relaying a streamed upstream response. Stops the transfer with an error
+    once more than PASSTHROUGH_MAX bytes came through (the client then sees a cut-off
+    download, never a short file passing for a whole one). Closing it releases the
+    upstream connection, also when the body was never read.
+    """
+    def __init__(self, r):
+        self.r = r
+
+    def __iter__(self):
+        sent = 0
+        for chunk in self.r.raw.stream(PASSTHROUGH_CHUNK, decode_content=False):
+            sent += len(chunk)
+            if PASSTHROUGH_MAX and sent > PASSTHROUGH_MAX:
+                raise OSError(f"upstream file larger than {PASSTHROUGH_MAX} bytes")
+            yield chunk
+
+    def close(self):
         try:
-            if link.get("rel") and ("stylesheet" in link.get("rel") or "preload" in link.get("rel")):
-                link.decompose()
+            self.r.close()
         except Exception:
             pass
-    for el in list(soup.find_all()):
-        if not isinstance(el, Tag):
-            continue
-        try:
-            id_attr = el.get("id", "") or ""
-            class_attr = " ".join(el.get("class", [])) if el.get("class") else ""
-            combined = (id_attr + " " + class_attr).lower()
-            if "cookie" in combined or "cookies" in combined or "vector-body-before-content" in combined:
-                el.decompose()
-                continue
-            text = (el.get_text(" ", strip=True) or "").lower()
-            if ("we use cookies" in text) or ("this site uses cookies" in text) or ("cookie" in text and len(text) < 200 and ("consent" in text or "accept" in text or "use cookies" in text)):
-                el.decompose()
-                continue
-        except Exception:
-            continue
-    selectors = ["#mw-head", "header", "nav", ".site-header", "#p-logo", ".portal", ".mw-portlet", ".sidebar", ".mw-sidebar", "#footer", ".mw-footer", ".site-footer", ".siteNotice", ".sitenotice", ".printfooter", "#catlinks", ".searchbox"]
-    for sel in selectors:
-        for el in list(soup.select(sel)):
-            try:
-                el.decompose()
-            except Exception:
-                pass
 
-# Reformat templates and tables for responsive layout
-def reformat_templates_and_tables(content_tag):
-    template_selectors = [".infobox", ".portable-infobox", ".vertical-navbox", ".navbox", ".thumb", ".thumbinner", ".sidebar", ".metadata", ".mbox", ".ambox", ".hatnote", ".toc"]
-    for sel in template_selectors:
-        for node in list(content_tag.select(sel)):
-            try:
-                style = node.get("style", "")
-                if style and "float" in style:
-                    new_style = ";".join([p for p in style.split(";") if "float" not in p.strip().lower()])
-                    new_style = new_style.strip(" ;")
-                    if new_style:
-                        node["style"] = new_style
-                    else:
-                        if "style" in node.attrs:
-                            del node.attrs["style"]
-                classes = node.get("class", [])
-                classes = [c for c in classes if c.lower() not in ("floatleft", "floatright", "tright", "tleft")]
-                if classes:
-                    node["class"] = classes
-                else:
-                    if "class" in node.attrs and not classes:
-                        del node.attrs["class"]
-                existing_style = node.get("style", "")
-                additions = "max-width:100%!important;float:none!important;clear:both!important;display:block!important;margin:0.6rem auto!important;box-sizing:border-box!important;"
-                node["style"] = (existing_style + ";" + additions).strip(";")
-                for img in node.find_all("img", src=True):
-                    img_style = img.get("style", "")
-                    if "max-width" not in img_style:
-                        img["style"] = (img_style + ";max-width:100%!important;height:auto!important;display:block;").strip(";")
-            except Exception:
-                continue
-    for table in list(content_tag.find_all("table")):
+def passthrough_response(r, body=None):
+    """Response relaying r; `body` replaces the plain UpstreamBody (see MediaDownload)."""
+    length = r.headers.get("Content-Length", "")
+    if PASSTHROUGH_MAX and length.isdigit() and int(length) > PASSTHROUGH_MAX:
+        r.close()
+        return Response("Remote file too large.", status=502)
+    headers = [(name, r.headers[name]) for name in _PASSTHROUGH_HEADERS if r.headers.get(name)]
+    return Response(body if body is not None else UpstreamBody(r), status=r.status_code, headers=headers)
+
+# ---- media proxy ----
+# Page images are linked as /media/<host>/<path> so readers never contact Miraheze's
+# file servers. Files are relayed as they arrive; those up to MEDIA_CACHE_MAX / 8 bytes
+# are written to the cache on the way through and kept in a byte-bounded LRU of their
+# own under CACHE_DIR/media (indexed and encrypted like pages).
+_MEDIA_DIRNAME = "media"
+_MEDIA_HOST_DOMAINS = ("miraheze.org", "wikitide.net")
+_MEDIA_TYPES = ("image/", "video/", "audio/")
+_MEDIA_REQUEST_HEADERS = _RANGE_HEADERS + ("If-None-Match", "If-Modified-Since")
+# uploaded SVGs open on our origin when viewed on their own: no scripts, no sniffing
+_MEDIA_SECURITY_HEADERS = {
+    "Content-Security-Policy": "default-src 'none'; img-src data:; style-src 'unsafe-inline'; sandbox",
+    "X-Content-Type-Options": "nosniff",
+}
+# a cached file: its body in records of this size (each packed and encrypted on its
+# own, so it is written and sent a record at a time), then a meta record, then its length
+_MEDIA_CHUNK = 64 * 1024
+_MEDIA_RECORD = struct.Struct(">I")  # length before each record
+# characters MediaWiki leaves unescaped in file URLs (wfUrlencode)
+_MEDIA_PATH_SAFE = "/;@$!*(),~:"
+
+def _media_dir():
+    return os.path.join(CACHE_DIR, _MEDIA_DIRNAME)
+
+def is_media_host(host):
+    host = host.lower()
+    return any(host == d or host.endswith("." + d) for d in _MEDIA_HOST_DOMAINS)
+
+def media_url(url):
+    """The /media/ URL for an absolute image URL, or the URL itself when it isn't proxied."""
+    if not MEDIA_PROXY:
+        return url
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not is_media_host(parsed.netloc):
+        return url
+    return f"/media/{parsed.netloc}{parsed.path}" + (f"?{parsed.query}" if parsed.query else "")
+
+def media_source(url):
+    # inverse of media_url()
+    if url.startswith("/media/"):
+        return "https://" + url[len("/media/"):]
+    return url
+
+def media_upstream_url(host, path, qs=""):
+    """Upstream URL for a /media/ request, or None when host isn't a Miraheze file host."""
+    if not is_media_host(host):
+        return None
+    return f"https://{host}/{quote(path, safe=_MEDIA_PATH_SAFE)}" + (f"?{qs}" if qs else "")
+
+def _delete_media(conn, fname):
+    # caller holds the index write lock
+    try:
+        os.remove(os.path.join(_media_dir(), fname))
+    except FileNotFoundError:
+        pass
+    conn.execute("DELETE FROM media WHERE fname = ?", (fname,))
+
+def _prune_media_if_needed(conn, keep=None):
+    # _prune_cache_if_needed() for the media cache
+    total = conn.execute("SELECT size FROM media_totals WHERE id = 0").fetchone()[0]
+    while total > MEDIA_CACHE_MAX:
+        victims = conn.execute(
+            "SELECT fname, size FROM media WHERE fname != ? ORDER BY atime LIMIT 32",
+            (keep or "",),
+        ).fetchall()
+        if not victims:
+            break
+        for fname, size in victims:
+            _delete_media(conn, fname)
+            total -= size
+            if total <= MEDIA_CACHE_MAX:
+                break
+
+def _write_media_record(f, data):
+    blob = pack_entry("none", data)
+    f.write(_MEDIA_RECORD.pack(len(blob)) + blob)
+
+def _read_media_record(f):
+    size = _MEDIA_RECORD.unpack(f.read(_MEDIA_RECORD.size))[0]
+    return unpack_entry(f.read(size))[1]
+
+class MediaBody:
+    """
+    Body of a cached file, decrypted a record at a time as it is sent. Seekable, so
+    werkzeug answers a Range request by skipping the records before it unread.
+    """
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end  # where the body records stop and the meta record starts
+        self.pos = 0
+        self.pending = b""
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk, self.pending = self.pending, b""
+        if not chunk:
+            if self.f.tell() >= self.end:
+                raise StopIteration
+            chunk = _read_media_record(self.f)
+        self.pos += len(chunk)
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset):
+        # every record but the last holds _MEDIA_CHUNK bytes
+        self.f.seek(0)
+        self.pos, self.pending = offset, b""
+        for _ in range(offset // _MEDIA_CHUNK):
+            if self.f.tell() >= self.end:
+                return
+            size = _MEDIA_RECORD.unpack(self.f.read(_MEDIA_RECORD.size))[0]
+            self.f.seek(size, os.SEEK_CUR)
+        if offset % _MEDIA_CHUNK and self.f.tell() < self.end:
+            self.pending = _read_media_record(self.f)[offset % _MEDIA_CHUNK:]
+
+    def close(self):
+        self.f.close()
+
+def media_lookup(key):
+    """
+    Return (meta, body, mtime) for a cached file, or None. meta holds the Content-Type,
+    length, our ETag for the body and the upstream validators; body is a MediaBody
+    reading the opened file (still readable if the file is replaced or evicted meanwhile).
+    """
+    fname = _key_to_filename(key)
+    try:
+        f = open(os.path.join(_media_dir(), fname), "rb")
+    except OSError:
+        return None
+    try:
+        mtime = os.fstat(f.fileno()).st_mtime
+        f.seek(-_MEDIA_RECORD.size, os.SEEK_END)
+        size = _MEDIA_RECORD.unpack(f.read(_MEDIA_RECORD.size))[0]
+        end = f.seek(-(_MEDIA_RECORD.size * 2 + size), os.SEEK_END)
+        meta = json.loads(_read_media_record(f))
+        f.seek(0)
+    except Exception:
+        f.close()
         try:
-            if table.has_attr("align"):
-                continue
-            style = table.get("style", "")
-            if style and "float" in style.lower():
-                continue
-            classes = [c.lower() for c in table.get("class", [])]
-            if any(c in ("floatleft", "floatright", "tleft", "tright") for c in classes):
-                continue
-            existing_style = table.get("style", "")
-            additions = "margin-left:auto;margin-right:auto;max-width:100%;"
-            table["style"] = (existing_style + ";" + additions).strip(";")
+            with _index_transaction() as conn:
+                _delete_media(conn, fname)
         except Exception:
-            continue
+            pass
+        return None
+    try:
+        _index().execute("UPDATE media SET atime = ? WHERE fname = ?", (time.time(), fname))
+    except Exception:
+        pass
+    return meta, MediaBody(f, end), mtime
 
-# Convert gallery markup to inline responsive gallery
-def reformat_galleries(content_tag, remote_sub, base_url):
+def media_store(key, tmp):
+    """Move a finished temp file into the media cache, evicting older files to make room."""
+    fname = _key_to_filename(key)
+    try:
+        with _index_transaction() as conn:
+            conn.execute(
+                "INSERT INTO media (fname, size, atime) VALUES (?, ?, ?) "
+                "ON CONFLICT (fname) DO UPDATE SET size = excluded.size, atime = excluded.atime",
+                (fname, os.path.getsize(tmp), time.time()),
+            )
+            _prune_media_if_needed(conn, keep=fname)
+            os.replace(tmp, os.path.join(_media_dir(), fname))
+    except Exception:
+        try:
+            os.remove(tmp)
+        except Exception:
+            pass
+
+class MediaDownload(UpstreamBody):
     """
-    Convert MediaWiki gallery markup into a responsive inline gallery.
-    - Prefer high-res URLs from srcset / data-srcset when available.
-    - If thumbnail URL contains '/thumb/', reconstruct the original full image URL.
-    - Preserve surrounding <a> link (href and basic attributes) when present so images remain clickable.
+    UpstreamBody that also writes the file to a temp file in the media cache, as
+    _MEDIA_CHUNK-sized records followed by its meta, and moves it into the cache once
+    the whole file came through. A download cut short, or longer than `limit` (no or
+    a wrong Content-Length), is relayed without being kept.
     """
-    def choose_best_src(img_tag):
-        # prefer srcset-like attributes (pick the last / largest entry)
-        for attr in ("srcset", "data-srcset", "data-file-srcset"):
-            val = img_tag.get(attr)
-            if val:
+    def __init__(self, r, key, meta, limit):
+        super().__init__(r)
+        self.key = key
+        self.meta = meta
+        self.limit = limit
+        self.f = self.tmp = None
+
+    def __iter__(self):
+        try:
+            Path(_media_dir()).mkdir(parents=True, exist_ok=True)
+            fd, self.tmp = tempfile.mkstemp(dir=_media_dir(), prefix=_key_to_filename(self.key) + ".", suffix=".tmp")
+            self.f = os.fdopen(fd, "wb")
+        except Exception:
+            self._discard()
+        digest, size, buffered = hashlib.sha256(), 0, b""
+        for chunk in super().__iter__():
+            if self.f is not None:
+                size += len(chunk)
                 try:
-                    entries = [e.strip() for e in val.split(",") if e.strip()]
-                    # last entry typically the largest; each entry: "url [w|x]"
-                    last = entries[-1]
-                    url = last.split()[0]
-                    if url.startswith("//"):
-                        return "https:" + url
-                    if url.startswith("/"):
-                        return f"https://{remote_sub}.miraheze.org{url}"
-                    return url
+                    if size > self.limit:
+                        raise OSError("file too large for the media cache")
+                    digest.update(chunk)
+                    buffered += chunk
+                    while len(buffered) >= _MEDIA_CHUNK:
+                        _write_media_record(self.f, buffered[:_MEDIA_CHUNK])
+                        buffered = buffered[_MEDIA_CHUNK:]
                 except Exception:
-                    pass
+                    self._discard()
+            yield chunk
+        if self.f is None:
+            return
+        try:
+            if buffered:
+                _write_media_record(self.f, buffered)
+            meta_record = pack_entry("none", json.dumps({**self.meta, "length": size, "etag": digest.hexdigest()[:16]}).encode("utf-8"))
+            self.f.write(_MEDIA_RECORD.pack(len(meta_record)) + meta_record + _MEDIA_RECORD.pack(len(meta_record)))
+            self.f.close()
+            self.f = None
+            media_store(self.key, self.tmp)
+            self.tmp = None
+        except Exception:
+            self._discard()
+
+    def _discard(self):
+        if self.f is not None:
+            try:
+                self.f.close()
+            except Exception:
+                pass
+            self.f = None
+        if self.tmp is not None:
+            try:
+                os.remove(self.tmp)
+            except Exception:
+                pass
+            self.tmp = None
+
+    def close(self):
+        super().close()
+        self._discard()
+
+def media_renew(key):
+    # upstream says the file is unchanged: restart its MEDIA_TTL
+    try:
+        now = time.time()
+        os.utime(os.path.join(_media_dir(), _key_to_filename(key)), (now, now))
+    except Exception:
+        pass
+
+def _media_headers(resp):
+    resp.headers.update(_MEDIA_SECURITY_HEADERS)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MEDIA_TTL
+    return resp
+
+def media_response(meta, body):
+    resp = Response(body, content_type=meta["content_type"])
+    resp.headers["Content-Length"] = str(meta["length"])
+    resp.set_etag(meta["etag"])
+    if meta.get("last_modified"):
+        resp.headers["Last-Modified"] = meta["last_modified"]
+    return _media_headers(resp).make_conditional(request, accept_ranges=True, complete_length=meta["length"])
+
+def media_steps(url):
+    """
+    Upstream steps returning the Response for a proxied file. A cached copy is served
+    while fresh, then revalidated with the upstream validators (and kept on upstream
+    errors); Range and conditional requests are answered from it. Without one the
+    file is relayed, and cached on the way through when it is small enough.
+    """
+    key = f"media:{url}"
+    cached = media_lookup(key) if MEDIA_CACHE_MAX > 0 else None
+    if cached is not None and (time.time() - cached[2]) <= MEDIA_TTL:
+        return media_response(cached[0], cached[1])
+
+    # files are mostly compressed already; identity lets us store and serve them as-is
+    headers = {"Accept-Encoding": "identity"}
+    if cached is not None:
+        meta = cached[0]
+        if meta.get("upstream_etag"):
+            headers["If-None-Match"] = meta["upstream_etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    elif has_request_context():
+        headers.update((name, request.headers[name]) for name in _MEDIA_REQUEST_HEADERS if request.headers.get(name))
+    try:
+        r = yield UpstreamRequest(url, headers, True)
+    except requests.RequestException:
+        r = None
+
+    if cached is not None and (r is None or r.status_code == 304 or r.status_code >= 500):
+        # unchanged, or the file server is down: keep serving our copy
+        if r is not None:
+            r.close()
+            if r.status_code == 304:
+                media_renew(key)
+        return media_response(cached[0], cached[1])
+    if cached is not None:
+        cached[1].close()
+    if r is None:
+        return Response("Could not reach the file server.", status=502)
+    if r.status_code >= 400:
+        r.close()
+        return Response("File not found.", status=404 if r.status_code in (404, 410) else 502)
+    content_type = r.headers.get("Content-Type", "")
+    if r.status_code in (200, 206) and not content_type.startswith(_MEDIA_TYPES):
+        r.close()
+        return Response("Not a media file.", status=403)
+
+    limit = MEDIA_CACHE_MAX // 8
+    length = r.headers.get("Content-Length", "")
+    if r.status_code != 200 or limit <= 0 or (length.isdigit() and int(length) > limit):
+        return _media_headers(passthrough_response(r))
+    meta = {
+        "content_type": content_type,
+        "upstream_etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }
+    resp = passthrough_response(r, MediaDownload(r, key, meta, limit))
+    # cached copies carry our own ETag; until then Last-Modified validates
+    resp.headers.pop("ETag", None)
+    return _media_headers(resp)
+
+def upstream_date(r):
+    """When upstream sent r, by its own clock (our time if it didn't say)."""
+    try:
+        return parsedate_to_datetime(r.headers["Date"]).timestamp()
+    except Exception:
+        return time.time()
+
+def upstream_validators(r):
+    """
+    Collect what we need to revalidate this page later: HTTP validators plus the
+    MediaWiki revision id from the page's RLCONF block when present, with when we
+    fetched it.
+    """
+    validators = {}
+    if r.headers.get("ETag"):
+        validators["etag"] = r.headers["ETag"]
+    if r.headers.get("Last-Modified"):
+        validators["last_modified"] = r.headers["Last-Modified"]
+    m = _REVISION_RE.search(r.text)
+    if m:
+        validators["revid"] = int(m.group(1))
+        validators["fetched"] = upstream_date(r)
+    return validators
+
+def fetch_page_info(remote_sub, title):
+    """
+    Cheap check of a page through the API (a few hundred bytes): upstream steps returning
+    (latest revision id, when it was last touched), or None when they can't be determined.
+    A page is touched by its edits and also when a template or module it uses changes.
+    A failing connection raises like any other upstream request.
+    """
+    url = (f"https://{remote_sub}.miraheze.org/w/api.php?action=query&prop=info&redirects=1"
+           f"&format=json&formatversion=2&titles={quote(title, safe='')}")
+    r = yield UpstreamRequest(url, None)
+    if r.status_code != 200:
+        return None
+    try:
+        page = r.json()["query"]["pages"][0]
+        touched = datetime.fromisoformat(page["touched"].replace("Z", "+00:00")).timestamp()
+        return page["lastrevid"], touched
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
 
-        # fallback to data-src / data-file-src / src
-        for attr in ("data-src", "data-file-src", "data-srcset", "data-original", "src"):
-            val = img_tag.get(attr)
-            if val:
-                if val.startswith("//"):
-                    return "https:" + val
-                if val.startswith("/"):
-                    return f"https://{remote_sub}.miraheze.org{val}"
-                return val
+def page_unchanged(info, validators):
+    """
+    Whether fetch_page_info() says our copy is current: no newer revision, and not
+    touched since we fetched it (in the same second counts as touched).
+    """
+    return (info is not None and info[0] == validators.get("revid")
+            and validators.get("fetched") is not None and info[1] < int(validators["fetched"]))
 
+def fetch_parsed_page(remote_sub, title):
+    """
+    Rendered content, categories and display title of a page from the parse API,
+    without the skin around it. Upstream steps returning (response, parse), parse being
+    None for a page that doesn't exist, or None when the API can't be used for this wiki.
+    A failing connection raises instead: the skinned page wouldn't load either.
+    """
+    url = (f"https://{remote_sub}.miraheze.org/w/api.php?action=parse&page={quote(title, safe='')}"
+           "&prop=text|categories|displaytitle|revid&redirects=1&disableeditsection=1"
+           "&disablelimitreport=1&format=json&formatversion=2")
+    r = yield UpstreamRequest(url, None)
+    if r.status_code != 200:
+        return None
+    try:
+        data = r.json()
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
         return None
+    error = data.get("error")
+    if error:
+        if isinstance(error, dict) and error.get("code") in ("missingtitle", "invalidtitle"):
+            return r, None
+        return None
+    parsed = data.get("parse")
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("text"), str):
+        return None
+    return r, parsed
 
-    def full_from_thumb(src):
-        # If a Wikimedia-style thumbnail URL contains '/thumb/', reconstruct the original image URL:
-        # Example thumb:
-        # https://upload.wikimedia.org/wikipedia/commons/thumb/0/0a/Filename.jpg/1200px-Filename.jpg
-        # original:
-        # https://upload.wikimedia.org/wikipedia/commons/0/0a/Filename.jpg
+def api_renders_fully(title):
+    """
+    Whether action=parse gives the whole page: it renders only the page's own wikitext,
+    not a category's members, a file's image and history or a special page. Namespace
+    names are localized per wiki, so every prefixed title counts as one of those.
+    """
+    return ":" not in title
+
+def parsed_page_tree(parsed):
+    """Wrap parse API output in the same #content layout the skinned page has."""
+    title = parsed.get("displaytitle") or escape(parsed.get("title") or "")
+    return parse_html(
+        '<div id="content">'
+        f'<h1 id="firstHeading" class="firstHeading mw-first-heading">{title}</h1>'
+        f'<div id="bodyContent"><div id="mw-content-text" class="mw-body-content">{parsed["text"]}</div></div>'
+        '</div>')
+
+def parsed_page_categories(parsed, remote_sub, custom_host):
+    """Category links for a parse API result in find_categories_early's format (hidden ones left out)."""
+    host_segment = custom_host if custom_host else remote_sub
+    items = []
+    for cat in parsed.get("categories") or []:
+        name = cat.get("category") if isinstance(cat, dict) else None
+        if not name or cat.get("hidden"):
+            continue
+        items.append((name.replace("_", " "), f"/{host_segment}/wiki/Category:{quote(name, safe=_TITLE_URL_SAFE)}"))
+    if not items:
+        return None
+    return [("Categories", f"/{host_segment}/wiki/Special:Categories")] + items
+
+# ---- page transform (lxml) ----
+# Upstream pages are parsed once with lxml and rewritten in place. Text and markup
+# follow BeautifulSoup's rules (whitespace-only strings collapsed when parsed,
+# attributes sorted, void elements as "<br/>"), which the pages were rendered with
+# before, so a page comes out byte-for-byte as it used to.
+_VOID_ELEMENTS = frozenset([
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr", "image", "img",
+    "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+])
+_MULTI_VALUED_ATTRS = {
+    "*": ("class", "accesskey", "dropzone"),
+    "a": ("rel", "rev"), "link": ("rel", "rev"), "area": ("rel",), "td": ("headers",), "th": ("headers",),
+    "form": ("accept-charset",), "object": ("archive",), "icon": ("sizes",), "iframe": ("sandbox",), "output": ("for",),
+}
+_RAW_TEXT_ELEMENTS = ("script", "style")
+_PRESERVE_WHITESPACE = ("pre", "textarea")
+_STRING_CONTAINERS = ("rt", "rp", "style", "script", "template")  # their text isn't part of the text around them
+_ASCII_SPACES = " \n\t\f\r"
+_NONWHITESPACE_RE = re.compile(r"\S+")
+_XML_INCOMPATIBLE_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def parse_html(text):
+    """Parse a page into an lxml tree and return its root element, or None if there is nothing to parse."""
+    parser = etree.HTMLParser()
+    try:
+        parser.feed(text)
+        root = parser.close()
+    except etree.LxmlError:
+        return None
+    if root is None:
+        return None
+    collapse_whitespace(root)
+    return root
+
+def collapse_whitespace(root):
+    """Reduce strings of only ASCII whitespace to a newline or a space, except inside <pre>/<textarea>."""
+    stack = [(root, False)]
+    while stack:
+        el, keep = stack.pop()
+        keep = keep or el.tag in _PRESERVE_WHITESPACE
+        if not keep and el.text and not el.text.strip(_ASCII_SPACES):
+            el.text = "\n" if "\n" in el.text else " "
+        for child in el:
+            if isinstance(child.tag, str):
+                stack.append((child, keep))
+            if not keep and child.tail and not child.tail.strip(_ASCII_SPACES):
+                child.tail = "\n" if "\n" in child.tail else " "
+
+def classes(el):
+    return _NONWHITESPACE_RE.findall(el.get("class") or "")
+
+def remove_element(el):
+    """Take el out of the tree, keeping the text that followed it."""
+    parent = el.getparent()
+    if parent is None:
+        return
+    if el.tail:
+        prev = el.getprevious()
         try:
-            if src.startswith("//"):
-                src = "https:" + src
-            if "/thumb/" in src:
-                prefix, rest = src.split("/thumb/", 1)
-                parts = rest.split("/")
-                # everything except last segment forms the original path to the file
-                if len(parts) >= 2:
-                    orig_path = "/".join(parts[:-1])
-                    return prefix + "/" + orig_path
-            return src
-        except Exception:
-            return src
+            if prev is not None:
+                prev.tail = (prev.tail or "") + el.tail
+            else:
+                parent.text = (parent.text or "") + el.tail
+        except ValueError:
+            # lxml refuses to store control characters it happily parsed
+            text = _XML_INCOMPATIBLE_RE.sub("", el.tail)
+            if prev is not None:
+                prev.tail = _XML_INCOMPATIBLE_RE.sub("", prev.tail or "") + text
+            else:
+                parent.text = _XML_INCOMPATIBLE_RE.sub("", parent.text or "") + text
+    parent.remove(el)
+
+def replace_element(old, new):
+    new.tail = old.tail
+    old.tail = None
+    old.getparent().replace(old, new)
+
+def is_attached(el, root):
+    while el is not None:
+        if el is root:
+            return True
+        el = el.getparent()
+    return False
+
+def _string_container(el):
+    for node in itertools.chain((el,), el.iterancestors()):
+        if node.tag in _STRING_CONTAINERS:
+            return node.tag
+    return None
+
+def element_text(el, separator="", strip=False):
+    """
+    Text of el the way BeautifulSoup's get_text() returns it: the strings in it joined
+    with separator, leaving out comments and the text of <script>, <style>, <template>
+    and ruby annotations unless el is one of those.
+    """
+    wanted = el.tag if el.tag in _STRING_CONTAINERS else None
+    pieces = []
+
+    def walk(node, container):
+        if node.text and container == wanted:
+            pieces.append(node.text)
+        for child in node:
+            if isinstance(child.tag, str):
+                walk(child, child.tag if child.tag in _STRING_CONTAINERS else container)
+            if child.tail and container == wanted:
+                pieces.append(child.tail)
+
+    walk(el, _string_container(el))
+    if strip:
+        pieces = [p.strip() for p in pieces]
+        pieces = [p for p in pieces if p]
+    return separator.join(pieces)
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def quote_attribute(value):
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+def _serialize_into(el, out):
+    tag = el.tag
+    if not isinstance(tag, str):
+        if tag is etree.Comment:
+            out.append("<!--" + (el.text or "") + "-->")
+        return
+    multi = _MULTI_VALUED_ATTRS.get(tag, ())
+    attrs = []
+    for key, value in sorted(el.attrib.items()):
+        if key in multi or key in _MULTI_VALUED_ATTRS["*"]:
+            value = " ".join(_NONWHITESPACE_RE.findall(value))
+        attrs.append(" " + key + "=" + quote_attribute(value))
+    if tag in _VOID_ELEMENTS and not el.text and len(el) == 0:
+        out.append("<" + tag + "".join(attrs) + "/>")
+        return
+    out.append("<" + tag + "".join(attrs) + ">")
+    raw = tag in _RAW_TEXT_ELEMENTS
+    if el.text:
+        out.append(el.text if raw else _escape(el.text))
+    for child in el:
+        _serialize_into(child, out)
+        if child.tail:
+            out.append(child.tail if raw else _escape(child.tail))
+    out.append("</" + tag + ">")
+
+def serialize(el):
+    """HTML for el and its contents (not the text after it)."""
+    out = []
+    _serialize_into(el, out)
+    return "".join(out)
+
+def _first(root, predicate):
+    for el in root.iterdescendants():
+        if isinstance(el.tag, str) and predicate(el):
+            return el
+    return None
+
+# Rewrite a link with special handling for categories and fragments
+def rewrite_link(a, remote_sub, custom_host, base_path, base_query):
+    raw = (a.get("href") or "").strip()
+    if not raw:
+        return
+    if raw.startswith("javascript:") or raw.startswith("mailto:"):
+        return
+    seg = custom_host if custom_host else remote_sub
+    # fragments: keep as-is
+    if raw.startswith("#"):
+        a.set("href", raw)
+        return
+    if raw.startswith("//"):
+        a.set("href", "https:" + raw)
+        return
+    if raw.startswith("http://") or raw.startswith("https://"):
+        parsed = urlparse(raw)
+        host = parsed.netloc.lower()
+        if host.endswith(".miraheze.org"):
+            sub = host.split(".")[0]
+            link_seg = seg if (custom_host and sub == remote_sub) else sub
+            # category path + query -> route to index.php for correct pagination
+            if parsed.path.startswith("/wiki/Category:") and parsed.query:
+                title = parsed.path[len("/wiki/"):]
+                new = f"/{quote(link_seg, safe='')}/w/index.php?title={quote(title, safe='')}"
+                if parsed.query:
+                    new += "&" + parsed.query
+                if parsed.fragment:
+                    new += "#" + parsed.fragment
+                a.set("href", new)
+            else:
+                new = f"/{quote(link_seg, safe='')}{parsed.path}"
+                if parsed.query:
+                    new += "?" + parsed.query
+                if parsed.fragment:
+                    new += "#" + parsed.fragment
+                a.set("href", new)
+        else:
+            a.set("target", "_blank")
+        return
+    if raw.startswith("/"):
+        parsed = urlparse(raw)
+        if parsed.path.startswith("/wiki/Category:") and parsed.query:
+            title = parsed.path[len("/wiki/"):]
+            new = f"/{quote(seg, safe='')}/w/index.php?title={quote(title, safe='')}"
+            if parsed.query:
+                new += "&" + parsed.query
+            if parsed.fragment:
+                new += "#" + parsed.fragment
+            a.set("href", new)
+            return
+        a.set("href", f"/{quote(seg, safe='')}{raw}")
+        return
+    if raw.startswith("?"):
+        # if base page is a category, rewrite to index.php?title=Category:...
+        if base_path.startswith("/wiki/Category:") or ("title=Category:" in base_query):
+            if base_path.startswith("/wiki/"):
+                title = base_path[len("/wiki/"):]
+            else:
+                title = ""
+                for part in base_query.split("&"):
+                    if part.startswith("title="):
+                        title = part[len("title="):]
+                        break
+            if title:
+                a.set("href", f"/{quote(seg, safe='')}/w/index.php?title={quote(title, safe='')}{raw}")
+            else:
+                a.set("href", f"/{quote(seg, safe='')}{base_path}{raw}")
+            return
+        a.set("href", f"/{quote(seg, safe='')}{base_path}{raw}")
+        return
+    # relative path without slash -> wiki page
+    a.set("href", f"/{quote(seg, safe='')}/wiki/{quote(raw, safe='')}")
+
+def absolute_image_url(src, remote_sub, base_url):
+    src = src.strip()
+    if src.startswith("//"):
+        return "https:" + src
+    if src.startswith("http://") or src.startswith("https://"):
+        return src
+    if src.startswith("/"):
+        return f"https://{remote_sub}.miraheze.org{src}"
+    return urljoin(base_url, src)
+
+def _map_srcset(value, func):
+    # apply func to each URL of a srcset ("url [descriptor], ...")
+    entries = []
+    for entry in value.split(","):
+        parts = entry.split()
+        if parts:
+            entries.append(" ".join([func(parts[0])] + parts[1:]))
+    return ", ".join(entries)
+
+# Point an image (src and srcset) at its absolute URL, through the media proxy, and load it lazily
+def normalize_image(img, remote_sub, base_url):
+    img.set("src", media_url(absolute_image_url(img.get("src") or "", remote_sub, base_url)))
+    if img.get("srcset"):
+        img.set("srcset", _map_srcset(img.get("srcset"), lambda u: media_url(absolute_image_url(u, remote_sub, base_url))))
+    if img.get("loading") is None:
+        img.set("loading", "lazy")
+
+# Extract categories early (from the raw page) to avoid accidental removal
+_CATEGORY_SELECTORS = [
+    (None, "class", "mw-catlinks"), (None, "id", "catlinks"), (None, "class", "mw-normal-catlinks"),
+    (None, "class", "catlinks"), ("div", "id", "catlinks"), ("div", "class", "mw-catlinks"),
+]
+
+def _matches(el, selector):
+    tag, kind, value = selector
+    if tag and el.tag != tag:
+        return False
+    if kind == "id":
+        return el.get("id") == value
+    return value in classes(el)
+
+def _category_links(node, remote_sub, custom_host):
+    items = []
+    for a in node.iterdescendants("a"):
+        if a.get("href") is None:
+            continue
+        text = element_text(a, strip=True)
+        href = a.get("href").strip()
+        if href.startswith("/wiki/"):
+            if custom_host:
+                link = f"/{custom_host}{href}"
+            else:
+                link = f"/{remote_sub}{href}"
+        elif href.startswith("http://") or href.startswith("https://"):
+            link = href
+        else:
+            link = href
+        items.append((text, link))
+    return items
 
-    for gallery in list(content_tag.select(".gallery, .mw-gallery, .gallerybox")):
+def _take_categories(root, selectors, candidates, remote_sub, custom_host):
+    # first match of each selector in turn; a matched box is removed even when it has no links
+    for sel in selectors:
+        node = next((el for el in candidates if _matches(el, sel) and is_attached(el, root)), None)
+        if node is not None:
+            items = _category_links(node, remote_sub, custom_host)
+            try:
+                remove_element(node)
+            except Exception:
+                pass
+            if items:
+                return items
+    return None
+
+def find_categories_early(root, wiki_param, remote_sub, custom_host):
+    candidates = root.xpath('//*[@id="catlinks" or contains(@class, "catlinks")]')
+    return _take_categories(root, _CATEGORY_SELECTORS, candidates, remote_sub, custom_host)
+
+def extract_categories_from_content(content_tag, wiki_param, remote_sub, custom_host):
+    candidates = content_tag.xpath('.//*[@id="catlinks" or contains(@class, "catlinks")]')
+    return _take_categories(content_tag, _CATEGORY_SELECTORS[:4], candidates, remote_sub, custom_host)
+
+# Page chrome removed before the content is extracted
+_CHROME_IDS = frozenset(["mw-head", "p-logo", "footer", "catlinks"])
+_CHROME_TAGS = frozenset(["header", "nav"])
+_CHROME_CLASSES = frozenset([
+    "site-header", "portal", "mw-portlet", "sidebar", "mw-sidebar", "mw-footer", "site-footer",
+    "siteNotice", "sitenotice", "printfooter", "searchbox",
+])
+
+# Longest text (stripped strings joined by spaces) an element may have and still be taken
+# for a cookie notice by its wording. Banners are short; anything longer is page content
+# that happens to mention cookies.
+_COOKIE_TEXT_LIMIT = 1000
+
+def _short_texts(root, limit=_COOKIE_TEXT_LIMIT):
+    """
+    Lower-cased element_text(el, " ", strip=True) for every element under root whose text
+    is at most limit characters long, built bottom-up from the children so each element
+    costs at most its own strings plus limit characters. Longer elements are left out.
+    """
+    texts = {}
+    for el in reversed([el for el in root.iter() if isinstance(el.tag, str)]):
+        parts = []
+        size = 0
+        if el.text:
+            piece = el.text.strip()
+            if piece:
+                parts.append(piece)
+                size += len(piece) + 1
+        for child in el:
+            if isinstance(child.tag, str) and (child.tag not in _STRING_CONTAINERS or child.tag == el.tag):
+                piece = texts.get(child)
+                if piece is None:
+                    size = limit + 2
+                    break
+                if piece:
+                    parts.append(piece)
+                    size += len(piece) + 1
+            if child.tail:
+                piece = child.tail.strip()
+                if piece:
+                    parts.append(piece)
+                    size += len(piece) + 1
+            if size > limit + 1:
+                break
+        if size <= limit + 1:
+            texts[el] = " ".join(parts).lower()
+    return texts
+
+def _is_cookie_notice(el, text):
+    id_attr = el.get("id", "") or ""
+    class_attr = " ".join(classes(el))
+    combined = (id_attr + " " + class_attr).lower()
+    if "cookie" in combined or "cookies" in combined or "vector-body-before-content" in combined:
+        return True
+    if not text:
+        return False
+    return ("we use cookies" in text) or ("this site uses cookies" in text) or ("cookie" in text and len(text) < 200 and ("consent" in text or "accept" in text or "use cookies" in text))
+
+def _is_chrome(el):
+    if el.tag in ("script", "style") or el.tag in _CHROME_TAGS:
+        return True
+    if el.tag == "link":
+        rel = _NONWHITESPACE_RE.findall(el.get("rel") or "")
+        if "stylesheet" in rel or "preload" in rel:
+            return True
+    if el.get("id") in _CHROME_IDS:
+        return True
+    return not _CHROME_CLASSES.isdisjoint(classes(el))
+
+def remove_unwanted_global(root):
+    """
+    Drop scripts, styles, stylesheet links, cookie notices and the skin's header,
+    navigation, sidebar and footer. One walk in document order; a removed element's
+    contents are not looked at, so the outermost matching element goes.
+    """
+    texts = _short_texts(root)
+    # lxml frees an element's proxy by looking up its ancestors for one still in use;
+    # keeping them all until the walk is done stops that from costing depth per element
+    visited = []
+    stack = [(root, False)]
+    while stack:
+        el, hidden = stack.pop()
+        visited.append(el)
         try:
-            items = []
-            processed_imgs = set()
-
-            # First, attempt to find anchor-wrapped images (preserve link)
-            for a in gallery.find_all("a"):
-                img = a.find("img")
-                if not img:
-                    continue
-                # avoid double-processing same img
-                if img in processed_imgs:
-                    continue
-                processed_imgs.add(img)
-
-                # choose best src
-                best = choose_best_src(img)
-                if not best:
-                    best = img.get("src") or ""
-                # try to convert thumbnail -> full if necessary
-                if "/thumb/" in best:
-                    best = full_from_thumb(best)
-
-                # normalize scheme/relative paths
-                if best.startswith("//"):
-                    best = "https:" + best
-                elif best.startswith("/"):
-                    best = f"https://{remote_sub}.miraheze.org{best}"
-                elif not best.startswith("http://") and not best.startswith("https://"):
-                    best = urljoin(base_url, best)
-
-                # caption fallback: gallerycaption, gallerytext, alt or title
-                caption = ""
-                # search for caption nearby
-                parent_li = a.find_parent(["li", "div"])
-                if parent_li:
-                    cap = parent_li.select_one(".gallerytext, .gallerycaption")
-                    if cap:
-                        caption = cap.get_text(" ", strip=True)
-                if not caption:
-                    caption = img.get("alt") or img.get("title") or ""
-
-                # preserve anchor href and attributes (we'll copy href and target if present)
-                ahref = a.get("href", "")
-                a_attrs = {}
-                if ahref:
-                    a_attrs["href"] = ahref
-                if a.get("target"):
-                    a_attrs["target"] = a.get("target")
-                if a.get("rel"):
-                    a_attrs["rel"] = " ".join(a.get("rel")) if isinstance(a.get("rel"), (list,tuple)) else a.get("rel")
-
-                items.append((best, caption, a_attrs))
-
-            # Next, any images not wrapped with anchor
-            for img in gallery.find_all("img"):
-                if img in processed_imgs:
-                    continue
-                processed_imgs.add(img)
-                best = choose_best_src(img)
-                if not best:
-                    best = img.get("src") or ""
-                if "/thumb/" in best:
-                    best = full_from_thumb(best)
-                if best.startswith("//"):
-                    best = "https:" + best
-                elif best.startswith("/"):
-                    best = f"https://{remote_sub}.miraheze.org{best}"
-                elif not best.startswith("http://") and not best.startswith("https://"):
-                    best = urljoin(base_url, best)
-
-                caption = ""
-                parent_li = img.find_parent(["li", "div"])
-                if parent_li:
-                    cap = parent_li.select_one(".gallerytext, .gallerycaption")
-                    if cap:
-                        caption = cap.get_text(" ", strip=True)
-                if not caption:
-                    caption = img.get("alt") or img.get("title") or ""
-
-                items.append((best, caption, {}))
-
-            if not items:
-                # No images found — skip
+            # get_text() sees nothing inside <template> or ruby annotations, except on the
+            # template or annotation itself
+            text = texts.get(el) if el.tag in _STRING_CONTAINERS or not hidden else None
+            if _is_chrome(el) or _is_cookie_notice(el, text):
+                if el is root:
+                    el.clear()
+                else:
+                    remove_element(el)
                 continue
+        except Exception:
+            pass
+        hidden = hidden or el.tag in _STRING_CONTAINERS
+        stack.extend(reversed([(child, hidden) for child in el if isinstance(child.tag, str)]))
 
-            # build new gallery node using the same parser for consistency
-            builder = BeautifulSoup("", "lxml")
-            gal = builder.new_tag("div", **{"class": "mirage-gallery"})
-            for src, caption, a_attrs in items:
-                item = builder.new_tag("div", **{"class": "mirage-gallery-item"})
-                # if we have an anchor, wrap image with it and copy href/target/rel
-                if a_attrs.get("href"):
-                    a_tag = builder.new_tag("a", href=a_attrs.get("href"))
-                    if a_attrs.get("target"):
-                        a_tag["target"] = a_attrs.get("target")
-                    if a_attrs.get("rel"):
-                        a_tag["rel"] = a_attrs.get("rel")
-                    imgtag = builder.new_tag("img", src=src)
-                    a_tag.append(imgtag)
-                    item.append(a_tag)
-                else:
-                    imgtag = builder.new_tag("img", src=src)
-                    item.append(imgtag)
-                if caption:
-                    c = builder.new_tag("div", **{"class": "caption"})
-                    c.string = caption
-                    item.append(c)
-                gal.append(item)
-
-            # replace original gallery with the constructed gallery
-            gallery.replace_with(gal)
+# Reformat templates and tables for responsive layout
+_TEMPLATE_CLASSES = ["infobox", "portable-infobox", "vertical-navbox", "navbox", "thumb", "thumbinner", "sidebar", "metadata", "mbox", "ambox", "hatnote", "toc"]
+
+def reformat_template(node):
+    style = node.get("style", "")
+    if style and "float" in style:
+        new_style = ";".join([p for p in style.split(";") if "float" not in p.strip().lower()])
+        new_style = new_style.strip(" ;")
+        if new_style:
+            node.set("style", new_style)
+        else:
+            if "style" in node.attrib:
+                del node.attrib["style"]
+    node_classes = [c for c in classes(node) if c.lower() not in ("floatleft", "floatright", "tright", "tleft")]
+    if node_classes:
+        node.set("class", " ".join(node_classes))
+    else:
+        if "class" in node.attrib and not node_classes:
+            del node.attrib["class"]
+    existing_style = node.get("style", "")
+    additions = "max-width:100%!important;float:none!important;clear:both!important;display:block!important;margin:0.6rem auto!important;box-sizing:border-box!important;"
+    node.set("style", (existing_style + ";" + additions).strip(";"))
+    for img in node.iterdescendants("img"):
+        if img.get("src") is None:
+            continue
+        img_style = img.get("style", "")
+        if "max-width" not in img_style:
+            img.set("style", (img_style + ";max-width:100%!important;height:auto!important;display:block;").strip(";"))
+
+def reformat_table(table):
+    if table.get("align") is not None:
+        return
+    style = table.get("style", "")
+    if style and "float" in style.lower():
+        return
+    table_classes = [c.lower() for c in classes(table)]
+    if any(c in ("floatleft", "floatright", "tleft", "tright") for c in table_classes):
+        return
+    existing_style = table.get("style", "")
+    additions = "margin-left:auto;margin-right:auto;max-width:100%;"
+    table.set("style", (existing_style + ";" + additions).strip(";"))
+
+# Convert gallery markup to an inline responsive gallery
+_GALLERY_CLASSES = frozenset(["gallery", "mw-gallery", "gallerybox"])
+
+def _gallery_image_src(img, remote_sub):
+    # prefer srcset-like attributes (pick the last / largest entry)
+    for attr in ("srcset", "data-srcset", "data-file-srcset"):
+        val = img.get(attr)
+        if val:
+            try:
+                entries = [e.strip() for e in val.split(",") if e.strip()]
+                # last entry typically the largest; each entry: "url [w|x]"
+                last = entries[-1]
+                url = media_source(last.split()[0])
+                if url.startswith("//"):
+                    return "https:" + url
+                if url.startswith("/"):
+                    return f"https://{remote_sub}.miraheze.org{url}"
+                return url
+            except Exception:
+                pass
+
+    # fallback to data-src / data-file-src / src
+    for attr in ("data-src", "data-file-src", "data-srcset", "data-original", "src"):
+        val = img.get(attr)
+        if val:
+            val = media_source(val)
+            if val.startswith("//"):
+                return "https:" + val
+            if val.startswith("/"):
+                return f"https://{remote_sub}.miraheze.org{val}"
+            return val
+
+    return None
+
+def _full_image_from_thumb(src):
+    # If a Wikimedia-style thumbnail URL contains '/thumb/', reconstruct the original image URL:
+    # Example thumb:
+    # https://upload.wikimedia.org/wikipedia/commons/thumb/0/0a/Filename.jpg/1200px-Filename.jpg
+    # original:
+    # https://upload.wikimedia.org/wikipedia/commons/0/0a/Filename.jpg
+    try:
+        if src.startswith("//"):
+            src = "https:" + src
+        if "/thumb/" in src:
+            prefix, rest = src.split("/thumb/", 1)
+            parts = rest.split("/")
+            # everything except last segment forms the original path to the file
+            if len(parts) >= 2:
+                orig_path = "/".join(parts[:-1])
+                return prefix + "/" + orig_path
+        return src
+    except Exception:
+        return src
+
+# Gallery tiles are a third of the 800px column, half the screen below 880px and all of
+# it below 520px; thumbnails are offered in these widths so the browser can pick one
+_GALLERY_WIDTHS = (320, 480, 640, 960)
+_GALLERY_SIZES = "(max-width: 520px) 100vw, (max-width: 880px) 50vw, 260px"
+# .../thumb/a/ab/File.jpg/[lossy-][page1-]320px-File.jpg
+_THUMB_RE = re.compile(r"^(.*/thumb/.+/)((?:lossy-|lossless-)?(?:page\d+-)?)(\d+)px-([^/]+)$")
+
+def thumb_width(src):
+    # width of a thumbnail URL, None for anything else
+    m = _THUMB_RE.match(src.partition("?")[0])
+    return int(m.group(3)) if m else None
+
+def thumb_url(src, width):
+    """The thumbnail URL src scaled to width (src must be a thumbnail URL)."""
+    path, sep, query = src.partition("?")
+    m = _THUMB_RE.match(path)
+    return f"{m.group(1)}{m.group(2)}{width}px-{m.group(4)}{sep}{query}"
+
+def _gallery_item(img, remote_sub, base_url):
+    """
+    Attributes of a gallery tile's <img>: for a thumbnail, a srcset of the sizes in
+    _GALLERY_WIDTHS smaller than the file (or, with its size unknown, the thumbnails
+    the page already had), the file itself standing in for the larger ones.
+    """
+    best = absolute_image_url(_gallery_image_src(img, remote_sub) or media_source(img.get("src") or ""), remote_sub, base_url)
+    attrs = {"src": media_url(best), "loading": "lazy"}
+    width, height = img.get("data-file-width") or "", img.get("data-file-height") or ""
+    if width.isdigit() and height.isdigit():
+        # lets the browser keep room for the image before it loads
+        attrs["width"], attrs["height"] = width, height
+    if thumb_width(best) is None:
+        return attrs
+
+    if width.isdigit():
+        file_width = int(width)
+        candidates = [(thumb_url(best, w), w) for w in _GALLERY_WIDTHS if w < file_width]
+        if file_width <= _GALLERY_WIDTHS[-1]:
+            candidates.append((_full_image_from_thumb(best), file_width))
+    else:
+        seen = {}
+        for attr in ("srcset", "src"):
+            for entry in (img.get(attr) or "").split(","):
+                parts = entry.split()
+                url = absolute_image_url(media_source(parts[0]), remote_sub, base_url) if parts else ""
+                w = thumb_width(url)
+                if w:
+                    seen.setdefault(w, url)
+        candidates = sorted(((url, w) for w, url in seen.items()), key=lambda c: c[1])
+    if not candidates:
+        return attrs
+    attrs["src"] = media_url(next((url for url, w in candidates if w >= _GALLERY_WIDTHS[0]), candidates[-1][0]))
+    attrs["srcset"] = ", ".join(f"{media_url(url)} {w}w" for url, w in candidates)
+    attrs["sizes"] = _GALLERY_SIZES
+    return attrs
+
+def _gallery_caption(el, img):
+    # caption fallback: gallerycaption, gallerytext, alt or title
+    caption = ""
+    parent = next((p for p in el.iterancestors() if p.tag in ("li", "div")), None)
+    if parent is not None:
+        cap = _first(parent, lambda c: "gallerytext" in classes(c) or "gallerycaption" in classes(c))
+        if cap is not None:
+            caption = element_text(cap, " ", strip=True)
+    if not caption:
+        caption = img.get("alt") or img.get("title") or ""
+    return caption
+
+def reformat_gallery(gallery, remote_sub, base_url):
+    """
+    Build a responsive inline gallery for MediaWiki gallery markup, or None if it has no images.
+    - Prefer high-res URLs from srcset / data-srcset when available.
+    - For thumbnails, offer tile-sized ones through srcset/sizes (see _gallery_item).
+    - Preserve surrounding <a> link (href and basic attributes) when present so images remain clickable.
+    """
+    items = []
+    # the same image markup twice in one gallery is shown once
+    processed_imgs = set()
+
+    # First, anchor-wrapped images (preserve link)
+    for a in gallery.iterdescendants("a"):
+        img = next(a.iterdescendants("img"), None)
+        if img is None:
+            continue
+        key = serialize(img)
+        if key in processed_imgs:
+            continue
+        processed_imgs.add(key)
+
+        a_attrs = {}
+        if a.get("href"):
+            a_attrs["href"] = a.get("href")
+        if a.get("target"):
+            a_attrs["target"] = a.get("target")
+        rel = _NONWHITESPACE_RE.findall(a.get("rel") or "")
+        if rel:
+            a_attrs["rel"] = " ".join(rel)
+        items.append((_gallery_item(img, remote_sub, base_url), _gallery_caption(a, img), a_attrs))
+
+    # Next, any images not wrapped with anchor
+    for img in gallery.iterdescendants("img"):
+        key = serialize(img)
+        if key in processed_imgs:
+            continue
+        processed_imgs.add(key)
+        items.append((_gallery_item(img, remote_sub, base_url), _gallery_caption(img, img), {}))
+
+    if not items:
+        return None
+
+    gal = etree.Element("div", {"class": "mirage-gallery"})
+    for img_attrs, caption, a_attrs in items:
+        item = etree.SubElement(gal, "div", {"class": "mirage-gallery-item"})
+        # if we have an anchor, wrap image with it and copy href/target/rel
+        parent = etree.SubElement(item, "a", a_attrs) if a_attrs.get("href") else item
+        etree.SubElement(parent, "img", img_attrs)
+        if caption:
+            etree.SubElement(item, "div", {"class": "caption"}).text = caption
+    return gal
+
+# Replace YouTube iframes with consent placeholders
+def _is_youtube(src):
+    src = src.lower()
+    return ("youtube.com" in src) or ("youtu.be" in src) or ("youtube-nocookie.com" in src)
+
+def replace_youtube(iframe):
+    wrapper = etree.Element("div", {"class": "mirage-embed-wrapper"})
+    replace_element(iframe, wrapper)
+    etree.SubElement(wrapper, "template", {"class": "mirage-embed-template"}).append(iframe)
+    placeholder = etree.SubElement(wrapper, "div", {"class": "mirage-yt-placeholder"})
+    etree.SubElement(placeholder, "p").text = "This Miraheze article contains an embedded YouTube video. Press yes if you're okay seeing it."
+    etree.SubElement(placeholder, "button", {"class": "mirage-yt-allow", "type": "button"}).text = "Yes"
+
+_IN_CONTENT_CLUTTER = frozenset(["pagetop", "vector-body-before-content", "mw-editsection"])
+
+# everything around the content; the head links the hashed assets (the script is not
+# deferred: it applies the stored dark mode / text size before the body renders)
+_PAGE_BANNER = (
+    '<div class="mirage-banner">'
+    "<strong>You're viewing this page on Mirage, a privacy frontend to Miraheze licensed under GPL 3.0.</strong>"
+    "<span>All text content on Miraheze is licensed under Creative Commons licenses.</span></div>"
+)
+_PAGE_START = (
+    '<!DOCTYPE html>\n<html><head><meta charset="utf-8"/>'
+    '<meta content="width=device-width, initial-scale=1" name="viewport"/>'
+    f'<link href={quote_attribute(CSS_URL)} rel="stylesheet"/><script src={quote_attribute(JS_URL)}></script>'
+    '</head><body><div class="mirage-container">' + _PAGE_BANNER
+)
+_PAGE_END = "</div></body></html>"
+
+def transform_content(content, wiki_param, remote_sub, custom_host, base_url):
+    """
+    Rewrite the page content in place. A single walk rewrites links and image URLs and
+    collects the galleries, YouTube embeds, templates and tables; those are then
+    reworked in that order (galleries first, so nothing is done to markup they replace).
+    """
+    base_parsed = urlparse(base_url)
+    base_path = base_parsed.path or ""
+    base_query = base_parsed.query or ""
+
+    galleries, iframes, tables = [], [], []
+    templates = [[] for _ in _TEMPLATE_CLASSES]
+    for el in content.iterdescendants():
+        tag = el.tag
+        if not isinstance(tag, str):
+            continue
+        try:
+            if tag == "a" and el.get("href") is not None:
+                rewrite_link(el, remote_sub, custom_host, base_path, base_query)
+            elif tag == "img" and el.get("src") is not None:
+                normalize_image(el, remote_sub, base_url)
+            elif tag == "iframe" and _is_youtube(el.get("src") or ""):
+                iframes.append(el)
+            elif tag == "table":
+                tables.append(el)
+        except Exception:
+            pass
+        el_classes = classes(el)
+        if el_classes:
+            if not _GALLERY_CLASSES.isdisjoint(el_classes):
+                galleries.append(el)
+            for nodes, cls in zip(templates, _TEMPLATE_CLASSES):
+                if cls in el_classes:
+                    nodes.append(el)
+
+    replaced = False
+    for gallery in galleries:
+        # galleries nested in one already replaced are gone with it
+        if replaced and not is_attached(gallery, content):
+            continue
+        try:
+            new = reformat_gallery(gallery, remote_sub, base_url)
+            if new is not None:
+                replace_element(gallery, new)
+                replaced = True
         except Exception:
             # don't let a gallery error break the whole page
             continue
 
-# Replace YouTube iframes with consent placeholders
-def detect_and_replace_youtube(content_tag):
-    builder = BeautifulSoup("", "lxml")
-    for iframe in list(content_tag.find_all("iframe", src=True)):
-        src = iframe.get("src", "") or ""
-        if ("youtube.com" in src.lower()) or ("youtu.be" in src.lower()) or ("youtube-nocookie.com" in src.lower()):
+    for iframe in iframes:
+        if replaced and not is_attached(iframe, content):
+            continue
+        try:
+            replace_youtube(iframe)
+        except Exception:
+            continue
+
+    # class by class: a node with several template classes is reformatted once for each
+    for nodes in templates:
+        for node in nodes:
+            if replaced and not is_attached(node, content):
+                continue
             try:
-                wrapper = builder.new_tag("div", **{"class": "mirage-embed-wrapper"})
-                tpl = builder.new_tag("template", **{"class": "mirage-embed-template"})
-                parent = iframe.parent
-                insert_index = None
-                if parent is not None:
-                    for idx, child in enumerate(list(parent.contents)):
-                        if child is iframe:
-                            insert_index = idx
-                            break
-                iframe_obj = iframe.extract()
-                tpl.append(iframe_obj)
-                placeholder = builder.new_tag("div", **{"class": "mirage-yt-placeholder"})
-                p = builder.new_tag("p")
-                p.string = "This Miraheze article contains an embedded YouTube video. Press yes if you're okay seeing it."
-                btn = builder.new_tag("button", **{"class": "mirage-yt-allow", "type": "button"})
-                btn.string = "Yes"
-                placeholder.append(p)
-                placeholder.append(btn)
-                wrapper.append(tpl)
-                wrapper.append(placeholder)
-                if parent is not None and insert_index is not None:
-                    parent.insert(insert_index, wrapper)
-                elif parent is not None:
-                    parent.append(wrapper)
-                else:
-                    content_tag.append(wrapper)
+                reformat_template(node)
             except Exception:
                 continue
-    for edit in list(content_tag.select(".mw-editsection")):
+    for table in tables:
+        if replaced and not is_attached(table, content):
+            continue
         try:
-            edit.decompose()
+            reformat_table(table)
+        except Exception:
+            continue
+
+# ---- negative cache (short-lived upstream errors) ----
+# Error results live in their own index table rather than as cache files, so they
+# are bounded by entry count (NEGATIVE_CACHE_MAX) and never evict real pages.
+def _negative_ttl(status):
+    if status in (404, 410):
+        return NEGATIVE_TTL_4XX
+    if status >= 500:
+        return NEGATIVE_TTL_5XX
+    return 0
+
+def negative_get(key: str):
+    """
+    Return a Response for a still-valid negative entry for key, else None.
+    """
+    try:
+        row = _index().execute(
+            "SELECT status, body FROM negative WHERE key_hash = ? AND expires > ?",
+            (hashlib.sha256(key.encode("utf-8")).hexdigest(), time.time()),
+        ).fetchone()
+    except Exception:
+        return None
+    if row is None:
+        return None
+    return Response(row[1], status=row[0])
+
+def negative_set(key: str, status, body, ttl):
+    if ttl <= 0 or NEGATIVE_CACHE_MAX <= 0:
+        return
+    now = time.time()
+    try:
+        with _index_transaction() as conn:
+            conn.execute(
+                "INSERT INTO negative (key_hash, status, body, expires) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key_hash) DO UPDATE SET status = excluded.status, body = excluded.body, "
+                "expires = excluded.expires",
+                (hashlib.sha256(key.encode("utf-8")).hexdigest(), status, body, now + ttl),
+            )
+            conn.execute("DELETE FROM negative WHERE expires <= ?", (now,))
+            excess = conn.execute("SELECT COUNT(*) FROM negative").fetchone()[0] - NEGATIVE_CACHE_MAX
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM negative WHERE key_hash IN "
+                    "(SELECT key_hash FROM negative ORDER BY expires LIMIT ?)",
+                    (excess,),
+                )
+    except Exception:
+        pass
+
+def error_response(key: str, message, status, ttl=None):
+    """
+    Build an error Response and remember it for a while (see _negative_ttl()) so
+    repeated requests for a broken page don't each cost an upstream round trip.
+    """
+    negative_set(key, status, message, _negative_ttl(status) if ttl is None else ttl)
+    return Response(message, status=status)
+
+# ---- cache-key normalization ----
+# Requests that MediaWiki would answer with the same page share one cache entry:
+# "Main_Page", "Main Page", "Main%20Page" and "main_Page" are all "Main_Page";
+# query parameters are sorted and tracking parameters dropped; "foo.miraheze.org"
+# is the same wiki as "foo".
+_CANONICAL_NAMESPACES = {ns.lower(): ns for ns in (
+    "Talk", "User", "User_talk", "Project", "Project_talk", "File", "File_talk", "Image",
+    "MediaWiki", "MediaWiki_talk", "Template", "Template_talk", "Help", "Help_talk",
+    "Category", "Category_talk", "Special", "Media", "Module", "Module_talk",
+)}
+_IGNORED_QUERY_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "_hsenc", "_hsmi", "ref", "ref_src"}
+# MediaWiki's wfUrlencode() leaves these unescaped in page URLs
+_TITLE_URL_SAFE = ";@$!*(),/~:"
+
+def _ucfirst(s):
+    if not s:
+        return s
+    first = s[0].upper()
+    return (first if len(first) == 1 else s[0]) + s[1:]
+
+def normalize_wiki(wiki_param):
+    wiki = wiki_param.strip().strip(".").lower()
+    if wiki.endswith(".miraheze.org"):
+        wiki = wiki[:-len(".miraheze.org")]
+    return wiki
+
+def normalize_title(title, wiki):
+    """
+    Canonical MediaWiki title form: decoded, underscores for spaces, no repeated or
+    surrounding underscores, and first letter (of the title and after a known
+    namespace) upper-cased unless the wiki is case-sensitive.
+    """
+    title = unquote(title).replace(" ", "_")
+    title = re.sub(r"_+", "_", title).strip("_")
+    if wiki in CASE_SENSITIVE_WIKIS:
+        return title
+    ns, sep, rest = title.partition(":")
+    canonical_ns = _CANONICAL_NAMESPACES.get(ns.lower()) if sep else None
+    if canonical_ns:
+        return f"{canonical_ns}:{_ucfirst(rest.lstrip('_'))}"
+    return _ucfirst(title)
+
+def normalize_query(qs, wiki):
+    pairs = []
+    for k, v in parse_qsl(qs, keep_blank_values=True):
+        if k in _IGNORED_QUERY_PARAMS or k.startswith("utm_"):
+            continue
+        if k == "title":
+            v = normalize_title(v, wiki)
+        pairs.append((k, v))
+    pairs.sort(key=lambda kv: kv[0])  # stable: repeated keys keep their order
+    return urlencode(pairs, quote_via=quote, safe=_TITLE_URL_SAFE)
+
+def normalize_request(wiki_param, path, mode, qs):
+    """
+    Return the canonical (wiki, path, qs) for a proxied request.
+    """
+    wiki = normalize_wiki(wiki_param)
+    if mode == 'wiki':
+        path = normalize_title(path, wiki)
+    return wiki, path, normalize_query(qs, wiki) if qs else ""
+
+_seen_aliases = set()
+_KEY_ALIASES_MAX = 100000  # spellings remembered for the stats; the oldest are forgotten first
+_KEY_ALIASES_PRUNE_EVERY = 1000  # new spellings between prunes
+
+def record_key_alias(raw_key, key):
+    """
+    Remember (as hashes only, no titles) which canonical key each distinct request
+    spelling maps to, so /api/stats can report how many duplicate cache entries
+    normalization avoided. Called only for keys with a cached page, and only the last
+    _KEY_ALIASES_MAX spellings (plus one prune's worth) are kept, so cache-busting
+    query strings can't grow the index without limit.
+    """
+    raw_hash = hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+    if raw_hash in _seen_aliases:
+        return
+    if len(_seen_aliases) > 10000:
+        _seen_aliases.clear()
+    _seen_aliases.add(raw_hash)
+    try:
+        conn = _index()
+        # known spelling (another worker's, or from before a restart) -> no write at all
+        if conn.execute("SELECT 1 FROM key_aliases WHERE raw_hash = ?", (raw_hash,)).fetchone():
+            return
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO key_aliases (raw_hash, key_hash) VALUES (?, ?)",
+            (raw_hash, hashlib.sha256(key.encode("utf-8")).hexdigest()),
+        )
+        if cur.rowcount > 0 and cur.lastrowid % _KEY_ALIASES_PRUNE_EVERY == 0:
+            # rowids grow with each insert, so this drops the oldest rows
+            conn.execute("DELETE FROM key_aliases WHERE rowid <= ?", (cur.lastrowid - _KEY_ALIASES_MAX,))
+    except Exception:
+        pass
+
+# ---- single-flight: one upstream fetch + transform per cache key ----
+# Within a worker, concurrent misses for the same key wait on the first request and
+# reuse its response. Across workers, the first one to claim the key in the index's
+# `flights` table fetches; the others poll the cache until the page lands there (or
+# the claim goes stale after SINGLE_FLIGHT_TIMEOUT, e.g. because its worker died).
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None  # (body, status, headers) once the leader has a shareable response
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def _flight_owner():
+    return f"{os.getpid()}:{threading.get_ident()}"
+
+def _claim_flight(key, owner=None):
+    """
+    Try to become the cross-worker leader for key. Returns True when this request
+    should fetch (also when the index is unusable, so we never block on it).
+    Waiters call this every poll, so a live claim is seen with a read alone: only a
+    missing or stale one costs a write, which would queue behind the leader's cache_set().
+    """
+    now = time.time()
+    try:
+        conn = _index()
+        row = conn.execute("SELECT started FROM flights WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] >= now - SINGLE_FLIGHT_TIMEOUT:
+            return False
+        cur = conn.execute(
+            "INSERT INTO flights (key, owner, started) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, started = excluded.started "
+            "WHERE flights.started < ?",
+            (key, owner or _flight_owner(), now, now - SINGLE_FLIGHT_TIMEOUT),
+        )
+        return cur.rowcount > 0
+    except Exception:
+        return True
+
+def _release_flight(key, owner=None):
+    try:
+        _index().execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, owner or _flight_owner()))
+    except Exception:
+        pass
+
+def _lead_flight(key, compute):
+    deadline = time.time() + SINGLE_FLIGHT_TIMEOUT
+    claimed = _claim_flight(key)
+    while not claimed:
+        # another worker is fetching this page; wait for it to land in the cache
+        time.sleep(0.05)
+        hit = cache_lookup(key)
+        if hit is not None:
+            return hit
+        if time.time() >= deadline:
+            break
+        claimed = _claim_flight(key)
+    try:
+        if claimed:
+            # the previous leader may have finished between our cache check and claim
+            hit = cache_lookup(key)
+            if hit is not None:
+                return hit
+        return compute()
+    finally:
+        if claimed:
+            _release_flight(key)
+
+def single_flight(key, compute):
+    """
+    Run compute() at most once at a time per key and hand concurrent callers for
+    the same key its result. compute() returns either a CacheHit for the page it
+    cached or a Response (errors, redirects, non-HTML passthrough), which waiters
+    get a copy of.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        if flight.done.wait(SINGLE_FLIGHT_TIMEOUT) and flight.result is not None:
+            if isinstance(flight.result, CacheHit):
+                return flight.result
+            body, status, headers = flight.result
+            return Response(body, status=status, headers=headers)
+        # leader timed out or produced a streamed response -> do the work ourselves
+        return compute()
+    try:
+        result = _lead_flight(key, compute)
+        if isinstance(result, CacheHit):
+            flight.result = result
+        elif not result.is_streamed:
+            flight.result = (result.get_data(), result.status_code, list(result.headers.items()))
+        return result
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+def cached_response(hit):
+    """
+    Build the response for a cached page, sending the stored compressed bytes
+    untouched when the client accepts that Content-Encoding.
+    Carries a strong ETag (per encoding) and Last-Modified from when the entry was
+    written (not its backdated TTL start, which may predate a re-rendering), and
+    turns into a 304 when the request's validators match.
+    """
+    etag = hashlib.sha256(hit.payload).hexdigest()[:32]
+    coding = hit_content_coding(hit)
+    if coding and has_request_context() and request.accept_encodings[coding]:
+        resp = Response(hit.payload, content_type="text/html; charset=utf-8")
+        resp.headers["Content-Encoding"] = coding
+        etag = f"{etag}-{coding}"
+    else:
+        resp = Response(hit_body(hit), content_type="text/html; charset=utf-8")
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(etag)
+    resp.last_modified = hit.written
+    if has_request_context():
+        resp = resp.make_conditional(request)
+    return resp
+
+# ---- background refresh of stale pages ----
+_refresh_pool = None
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+def _refresh_in_background(key, compute):
+    """
+    Queue compute() to re-fetch an expired page, at most once per key at a time.
+    Failures are ignored: the stale copy simply stays in the cache, unless the
+    page has been deleted upstream.
+    """
+    global _refresh_pool
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(max_workers=max(1, REFRESH_WORKERS), thread_name_prefix="mirage-refresh")
+        _refreshing.add(key)
+
+    def run():
+        try:
+            result = single_flight(key, compute)
+            if isinstance(result, Response) and result.status_code in (404, 410):
+                # page is gone upstream -> stop serving the stale copy
+                cache_delete(key)
         except Exception:
             pass
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(key)
+
+    try:
+        _refresh_pool.submit(run)
+    except Exception:
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+# ---- early flush ----
+# With MIRAGE_EARLY_FLUSH on, a browser that misses the cache gets the page shell (head
+# with the CSS and JS links, banner) at once and the content when the fetch and transform
+# are done, so it can load the assets and paint meanwhile. The 200 is sent before the
+# outcome is known: errors and redirects become a notice in the page. Clients that don't
+# ask for text/html explicitly (API consumers, curl) keep getting real status codes.
+def _wants_early_flush():
+    return has_request_context() and request.method == "GET" and "text/html" in request.accept_mimetypes.values()
+
+def _page_notice(heading, message, head=""):
+    return (
+        head + '<div id="content"><h1 id="firstHeading">' + _escape(heading) + "</h1><p>"
+        + message + "</p></div>" + _PAGE_END
+    )
+
+def _page_remainder(result):
+    """
+    What follows _PAGE_START for the outcome of a page fetch: the rest of the page, or
+    a notice standing in for an error or redirect.
+    """
+    if isinstance(result, CacheHit):
+        # a page cached by another build links other asset URLs; take it from the banner on
+        _, banner, rest = hit_body(result).partition(_PAGE_BANNER.encode("utf-8"))
+        if banner:
+            return rest
+        return _page_notice("Error", "The page could not be shown. Please reload.")
+    result.close()  # e.g. a relayed file we won't send
+    location = result.headers.get("Location")
+    if 300 <= result.status_code < 400 and location:
+        link = quote_attribute(location)
+        return _page_notice(
+            "Redirecting",
+            "This page has moved to <a href=" + link + ">" + _escape(location) + "</a>.",
+            head="<meta content=" + quote_attribute("0; url=" + location) + ' http-equiv="refresh"/>',
+        )
+    message = result.get_data(as_text=True) if result.status_code >= 400 else "The page could not be shown."
+    return _page_notice("Error", _escape(message))
+
+def early_flush_response(cache_key, compute, hit=None):
+    def generate():
+        yield _PAGE_START
+        try:
+            result = _page_or_stale(single_flight(cache_key, compute), hit)
+        except Exception:
+            result = Response("Error rendering the page.", status=500)
+        yield _page_remainder(result)
+
+    resp = Response(generate(), content_type="text/html; charset=utf-8")
+    resp.headers["X-Accel-Buffering"] = "no"  # nginx would otherwise hold the shell back
+    return resp
+
+# ---- transform pool ----
+# With MIRAGE_TRANSFORM_WORKERS set, pages are rendered in a pool of processes so a huge
+# page burns its own CPU instead of holding the GIL of the worker serving requests. A
+# render gets TRANSFORM_CPU_BUDGET seconds of CPU time (a virtual timer in the pool
+# process); a page over budget, or one arriving while TRANSFORM_QUEUE others are queued
+# or rendering, is answered with a 503 right away.
+class TransformBudgetExceeded(BaseException):
+    # not an Exception: the transform's best-effort `except Exception` blocks must not swallow it
+    pass
+
+class TransformQueueFull(Exception):
+    pass
+
+_transform_pool = None
+_transform_pending = 0
+_transform_lock = threading.Lock()
+
+def _over_budget(signum, frame):
+    raise TransformBudgetExceeded()
+
+def _run_with_budget(func, args, budget):
+    # runs in a pool process
+    timed = budget > 0 and hasattr(signal, "setitimer")
+    if timed:
+        signal.signal(signal.SIGVTALRM, _over_budget)
+        signal.setitimer(signal.ITIMER_VIRTUAL, budget)
+    try:
+        return func(*args)
+    finally:
+        if timed:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+
+def run_transform(func, *args):
+    """
+    Return func(*args), computed in the transform pool when there is one (func and its
+    arguments must then be picklable), else on this thread. Raises TransformQueueFull,
+    TransformBudgetExceeded or BrokenProcessPool.
+    """
+    global _transform_pool, _transform_pending
+    if TRANSFORM_WORKERS <= 0:
+        return func(*args)
+    with _transform_lock:
+        if _transform_pending >= max(1, TRANSFORM_QUEUE):
+            raise TransformQueueFull()
+        if _transform_pool is None:
+            # spawn: forking a threaded worker with open SQLite connections isn't safe
+            _transform_pool = ProcessPoolExecutor(max_workers=TRANSFORM_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        pool = _transform_pool
+        _transform_pending += 1
+    try:
+        return pool.submit(_run_with_budget, func, args, TRANSFORM_CPU_BUDGET).result()
+    except BrokenProcessPool:
+        # a pool process died (e.g. OOM-killed); the next render starts a fresh pool
+        with _transform_lock:
+            if _transform_pool is pool:
+                _transform_pool = None
+        pool.shutdown(wait=False)
+        raise
+    finally:
+        with _transform_lock:
+            _transform_pending -= 1
+
+def transform_or_error(cache_key, func, *args):
+    """
+    run_transform(), with its failures turned into the Response to send instead.
+    """
+    try:
+        return run_transform(func, *args)
+    except TransformQueueFull:
+        return Response("Too many pages are being rendered, try again shortly.", status=503, headers={"Retry-After": "2"})
+    except TransformBudgetExceeded:
+        return error_response(cache_key, "This page is too large to render.", 503)
+    except BrokenProcessPool:
+        return Response("Error rendering the page.", status=500)
 
 # --- Core fetch and transform ---
 def fetch_and_transform(wiki_param, path, mode='wiki', qs=''):
     """
     This version attempts to serve from the file cache first (HTML only).
-    Cache key includes wiki_param|mode|path|qs so different pages/queries are separate.
+    Cache key includes wiki|mode|path|qs (after normalize_request()) so different
+    pages/queries are separate and equivalent spellings of one page are not, plus
+    TRANSFORM_VERSION; the upstream documents are cached apart (see _page_steps()).
+    Concurrent misses for the same key are coalesced into one upstream fetch.
+    Pages up to CACHE_STALE past their TTL are served immediately and refreshed in
+    the background; up to CACHE_STALE_IF_ERROR past it they stand in for upstream errors.
+    With EARLY_FLUSH, browsers that miss on an article get it streamed (see early_flush_response()).
+    """
+    looked_up = lookup_page(wiki_param, path, mode, qs)
+    if isinstance(looked_up, Response):
+        return looked_up
+    cache_key, steps, hit = looked_up
+    compute = lambda: run_upstream(steps())
+
+    if EARLY_FLUSH and mode == 'wiki' and _wants_early_flush() and negative_get(cache_key) is None:
+        return early_flush_response(cache_key, compute, hit)
+
+    result = _page_or_stale(single_flight(cache_key, compute), hit)
+    if isinstance(result, CacheHit):
+        return cached_response(result)
+    return result
+
+PageMiss = namedtuple("PageMiss", ["cache_key", "steps", "hit"])
+# the upstream document a rendering is made from: its cache key (None when it wasn't
+# kept), date and validators, which the rendering is stored with
+UpstreamCopy = namedtuple("UpstreamCopy", ["key", "mtime", "validators"])
+
+def lookup_page(wiki_param, path, mode='wiki', qs='', background=True):
+    """
+    The part of fetch_and_transform() that needs no upstream fetch. Returns the
+    Response when that settles the request (cached page, known custom domain), else a
+    PageMiss: the cache key, a function making the upstream steps that produce the
+    page, and the expired cached copy if there is one. With `background` off, expired
+    pages are misses rather than served while a background refresh runs.
     """
     # build canonical cache key
-    cache_key = f"{wiki_param}|{mode}|{path}|{qs}"
+    raw_key = f"{wiki_param}|{mode}|{path}|{qs}"
+    wiki_param, path, qs = normalize_request(wiki_param, path, mode, qs)
+    canonical_key = f"{wiki_param}|{mode}|{path}|{qs}"
+    cache_key = f"{canonical_key}|{TRANSFORM_VERSION}"
+
+    # a wiki known to have its own domain -> send the reader there without asking Miraheze
+    if '.' not in wiki_param:
+        custom_host = custom_host_for(wiki_param)
+        if custom_host:
+            return custom_host_redirect(custom_host, path, mode, qs)
+
+    steps = lambda: _page_steps(wiki_param, path, mode, qs, cache_key)
 
     # Try cache first (only cache text/html pages we previously stored)
-    cached = cache_get(cache_key)
-    if cached is not None:
-        # Return cached HTML response directly
-        return Response(cached, content_type="text/html; charset=utf-8")
+    hit = cache_lookup(cache_key, max_stale=CACHE_MAX_STALE)
+    if hit is not None:
+        record_key_alias(raw_key, canonical_key)
+        if is_fresh(hit):
+            # Return cached HTML response directly
+            return cached_response(hit)
+        if background and (time.time() - hit.mtime) <= CACHE_TTL + CACHE_STALE:
+            _refresh_in_background(cache_key, lambda: run_upstream(steps()))
+            return cached_response(hit)
+    return PageMiss(cache_key, steps, hit)
+
+def _page_or_stale(result, hit):
+    if isinstance(result, CacheHit):
+        return result
+    if hit is not None and result.status_code >= 500 and (time.time() - hit.mtime) <= CACHE_TTL + CACHE_STALE_IF_ERROR:
+        # upstream down or timing out -> keep serving the last good copy
+        return hit
+    return result
+
+def _page_steps(wiki_param, path, mode, qs, cache_key):
+    """
+    Upstream steps fetching, rendering and caching one page; they return a CacheHit
+    for the cached page or the Response to send instead.
+    The upstream document is cached as well, under "raw|<url>" ("raw|api|<url>" for
+    action=parse results), and the rendering is dated like the copy it was made from
+    and stored with its validators. While that copy is fresh a missing rendering (new
+    TRANSFORM_VERSION, another spelling of the wiki) is made from it without asking
+    Miraheze; once expired it is revalidated with its validators, or with the
+    rendering's when the copy was evicted.
+    """
+    # recently failed -> answer from the negative cache without going upstream
+    negative = negative_get(cache_key)
+    if negative is not None:
+        return negative
 
-    # Not cached -> continue original flow to fetch + transform
     remote_sub = derive_remote_subdomain(wiki_param)
     if mode == 'wiki':
-        remote_url = f"https://{remote_sub}.miraheze.org/wiki/{path}"
+        remote_url = f"https://{remote_sub}.miraheze.org/wiki/{quote(path, safe=_TITLE_URL_SAFE)}"
     else:
-        remote_url = f"https://{remote_sub}.miraheze.org/w/{path}"
+        remote_url = f"https://{remote_sub}.miraheze.org/w/{quote(path, safe=_TITLE_URL_SAFE)}"
         if qs:
             remote_url += '?' + qs
+    use_api = FETCH_MODE == "api" and mode == 'wiki' and api_renders_fully(path)
+    api_key, scrape_key = f"raw|api|{remote_url}", f"raw|{remote_url}"
+
+    def render(raw_key, raw):
+        text = hit_body(raw).decode("utf-8")
+        upstream = UpstreamCopy(raw_key, raw.mtime, cache_validators(raw_key))
+        if raw_key == api_key:
+            return _render_parsed_page(json.loads(text), wiki_param, remote_sub, remote_url, cache_key, upstream)
+        return _render_scraped_page(text, wiki_param, path, mode, qs, remote_sub, remote_url, cache_key, upstream)
+
+    def renew(raw_key):
+        # upstream copy unchanged -> restart its TTL and its rendering's (or render it);
+        # without the copy, the rendering alone
+        raw = cache_renew(raw_key, memory=False) if raw_key else None
+        if raw is None:
+            return cache_renew(cache_key)
+        return cache_renew(cache_key) or render(raw_key, raw)
+
+    raw_key, raw = None, None
+    for key in ((api_key, scrape_key) if use_api else (scrape_key,)):
+        raw = cache_lookup(key, max_stale=CACHE_MAX_STALE, memory=False)
+        if raw is not None:
+            raw_key = key
+            break
+    if raw is not None and is_fresh(raw):
+        return render(raw_key, raw)
+
+    # an expired copy we can revalidate instead of downloading again
+    validators = cache_validators(raw_key if raw is not None else cache_key)
+    conditional = {}
+    if validators.get("etag"):
+        conditional["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        conditional["If-Modified-Since"] = validators["last_modified"]
+    if not conditional and validators.get("revid") and mode == 'wiki':
+        try:
+            info = yield from fetch_page_info(remote_sub, path)
+        except requests.RequestException as e:
+            return error_response(cache_key, f"Error fetching remote wiki: {e}", 502)
+        if page_unchanged(info, validators):
+            renewed = renew(raw_key)
+            if renewed is not None:
+                return renewed
+
+    if use_api:
+        try:
+            fetched = yield from fetch_parsed_page(remote_sub, path)
+        except requests.RequestException as e:
+            return error_response(cache_key, f"Error fetching remote wiki: {e}", 502)
+        # None -> API disabled or failing on this wiki; scrape the skinned page below
+        if fetched is not None:
+            parsed = fetched[1]
+            if parsed is None:
+                cache_delete(api_key)
+                return error_response(cache_key, "Remote returned 404", 404)
+            # a redirect into another namespace is scraped below like a link to it
+            if api_renders_fully(parsed.get("title", "")):
+                validators = {"revid": parsed["revid"], "fetched": upstream_date(fetched[0])} if parsed.get("revid") else None
+                stored = cache_set(api_key, json.dumps(parsed), validators, raw=True)
+                upstream = UpstreamCopy(api_key if stored else None, stored.mtime if stored else None, validators)
+                return _render_parsed_page(parsed, wiki_param, remote_sub, remote_url, cache_key, upstream)
+
+    # a file is relayed as it arrives: fetch it in an encoding the reader accepts,
+    # and a client resuming or seeking in it gets its range from upstream
+    encoding = {"Accept-Encoding": upstream_accept_encoding()}
+    ranged = dict(encoding)
+    if has_request_context():
+        ranged.update((name, request.headers[name]) for name in _RANGE_HEADERS if request.headers.get(name))
 
     try:
-        r = fetch_remote(remote_url)
+        r = yield UpstreamRequest(remote_url, {**conditional, **ranged}, True)
+        if r.status_code == 304:
+            renewed = renew(scrape_key)
+            if renewed is not None:
+                return renewed
+            # entry vanished meanwhile -> need the full page after all
+            r.close()
+            r = yield UpstreamRequest(remote_url, ranged, True)
+        if r.status_code == 206 and "text/html" in r.headers.get("Content-Type", ""):
+            # part of a page is no use to us
+            r.close()
+            r = yield UpstreamRequest(remote_url, {**conditional, **encoding}, True)
     except requests.RequestException as e:
-        return Response(f"Error fetching remote wiki: {e}", status=502)
+        return error_response(cache_key, f"Error fetching remote wiki: {e}", 502)
 
     if r.status_code >= 400:
-        return Response(f"Remote returned {r.status_code}", status=r.status_code)
+        r.close()
+        if r.status_code in (404, 410):
+            cache_delete(scrape_key)
+        return error_response(cache_key, f"Remote returned {r.status_code}", r.status_code)
 
     content_type = r.headers.get("Content-Type", "")
     if "text/html" not in content_type:
-        resp = Response(r.content, status=r.status_code)
-        resp.headers["Content-Type"] = content_type
+        resp = passthrough_response(r)
+        resp.vary.add("Accept-Encoding")
         return resp
 
-    original = BeautifulSoup(r.text, "lxml")
+    upstream = UpstreamCopy(None, None, None)
+    if r.status_code == 200:
+        validators = upstream_validators(r)
+        stored = cache_set(scrape_key, r.text, validators, raw=True)
+        upstream = UpstreamCopy(scrape_key if stored else None, stored.mtime if stored else None, validators)
+    return _render_scraped_page(r.text, wiki_param, path, mode, qs, remote_sub, remote_url, cache_key, upstream)
+
+def _render_scraped_page(text, wiki_param, path, mode, qs, remote_sub, remote_url, cache_key, upstream):
+    transformed = transform_or_error(cache_key, transform_scraped_page, text, wiki_param, remote_sub, remote_url)
+    if isinstance(transformed, Response):
+        return transformed
+    custom_host, final_html = transformed
+    if custom_host is None and final_html is None:
+        return error_response(cache_key, "No content found on remote page.", 502, ttl=NEGATIVE_TTL_NO_CONTENT)
+    remember_custom_host(remote_sub, custom_host)
+
+    # redirect if custom_host detected and incoming wiki_param was raw subdomain (no dot)
+    if custom_host and '.' not in wiki_param:
+        return custom_host_redirect(custom_host, path, mode, qs)
+
+    if final_html is None:
+        return error_response(cache_key, "No content found on remote page.", 502, ttl=NEGATIVE_TTL_NO_CONTENT)
+    return _store_page(cache_key, final_html, upstream)
+
+def transform_scraped_page(text, wiki_param, remote_sub, remote_url):
+    """
+    Upstream HTML of a skinned page -> (custom_host, final_html). No HTML when the page
+    has no content, or when a custom host turned up for a bare subdomain (the reader gets
+    redirected there, so rendering would be wasted). Touches no shared state, so it can
+    run in the transform pool.
+    """
+    original = parse_html(text)
+    if original is None:
+        return None, None
 
     # detect custom host via canonical / og:url
-    detected_host = detect_custom_host_from_soup(original)
+    detected_host = detect_custom_host(original)
     custom_host = None
     if detected_host and not detected_host.endswith('.miraheze.org'):
         custom_host = detected_host
-
-    # redirect if custom_host detected and incoming wiki_param was raw subdomain (no dot)
     if custom_host and '.' not in wiki_param:
-        out_path = path
-        out_qs = qs
-        location = f"/{custom_host}/{ 'wiki' if mode=='wiki' else 'w' }/{out_path}"
-        if out_qs:
-            location = location + "?" + out_qs
-        return Response(status=302, headers={"Location": location})
+        return custom_host, None
 
     # extract categories early, then remove global bits
     categories = find_categories_early(original, wiki_param, remote_sub, custom_host)
     remove_unwanted_global(original)
+    return custom_host, render_page(original, wiki_param, remote_sub, custom_host, remote_url, categories)
+
+def _render_parsed_page(parsed, wiki_param, remote_sub, remote_url, cache_key, upstream):
+    # the API has no canonical URL to detect a custom host from; use the one we know of
+    custom_host = wiki_param if '.' in wiki_param else custom_host_for(remote_sub)
+    categories = parsed_page_categories(parsed, remote_sub, custom_host)
+    final_html = transform_or_error(cache_key, transform_parsed_page, parsed, wiki_param, remote_sub, custom_host, remote_url, categories)
+    if isinstance(final_html, Response):
+        return final_html
+    if final_html is None:
+        return error_response(cache_key, "No content found on remote page.", 502, ttl=NEGATIVE_TTL_NO_CONTENT)
+    return _store_page(cache_key, final_html, upstream)
+
+def transform_parsed_page(parsed, wiki_param, remote_sub, custom_host, remote_url, categories):
+    """
+    action=parse result -> final HTML, or None when it has no content. Pool-safe like
+    transform_scraped_page().
+    """
+    original = parsed_page_tree(parsed)
+    if original is None:
+        return None
+    remove_unwanted_global(original)
+    return render_page(original, wiki_param, remote_sub, custom_host, remote_url, categories)
+
+def _store_page(cache_key, final_html, upstream):
+    # cache the generated HTML (best-effort; failures are non-fatal)
+    try:
+        hit = cache_set(cache_key, final_html, upstream.validators, upstream.mtime, source=upstream.key)
+    except Exception:
+        hit = None
+    if hit is not None:
+        return hit
 
+    return Response(final_html, content_type="text/html; charset=utf-8")
+
+def render_page(original, wiki_param, remote_sub, custom_host, remote_url, categories=None):
+    """
+    Turn an upstream document (already stripped of global chrome) into the final Mirage
+    page. Returns the HTML, or None when it has no content area.
+    """
     # find content
-    content_tag = original.find(id="content")
-    if not content_tag:
-        candidate = original.select_one("#mw-content-text, #bodyContent, main")
-        if candidate:
-            wrapper = original.new_tag("div", id="content")
-            for child in list(candidate.contents):
-                wrapper.append(child.extract())
-            candidate.replace_with(wrapper)
+    content_tag = next(iter(original.xpath('//*[@id="content"]')), None)
+    if content_tag is None:
+        candidate = next(iter(original.xpath('//*[@id="mw-content-text" or @id="bodyContent" or self::main]')), None)
+        if candidate is not None:
+            wrapper = etree.Element("div", {"id": "content"})
+            wrapper.text = candidate.text
+            for child in list(candidate):
+                wrapper.append(child)
+            replace_element(candidate, wrapper)
             content_tag = wrapper
 
-    if not content_tag:
-        return Response("No content found on remote page.", status=502)
+    if content_tag is None:
+        return None
 
     # remove in-content undesired elements
-    for bad in list(content_tag.select("#mw-cookiewarning-container, .pagetop, .vector-body-before-content")):
-        try:
-            bad.decompose()
-        except Exception:
-            pass
-    for edit in list(content_tag.select(".mw-editsection")):
-        try:
-            edit.decompose()
-        except Exception:
-            pass
+    stack = list(content_tag)
+    while stack:
+        el = stack.pop()
+        if not isinstance(el.tag, str):
+            continue
+        if el.get("id") == "mw-cookiewarning-container" or not _IN_CONTENT_CLUTTER.isdisjoint(classes(el)):
+            try:
+                remove_element(el)
+            except Exception:
+                pass
+            continue
+        stack.extend(el)
+    # removals can leave whitespace-only strings side by side; they read as one
+    collapse_whitespace(content_tag)
 
-    # build minimal doc
-    doc = BeautifulSoup("<!doctype html><html><head></head><body></body></html>", "lxml")
-    head = doc.head
-    head.append(doc.new_tag("meta", attrs={"charset": "utf-8"}))
-    head.append(doc.new_tag("meta", attrs={"name": "viewport", "content": "width=device-width, initial-scale=1"}))
-    style_tag = doc.new_tag("style")
-    style_tag.string = INJECT_CSS
-    head.append(style_tag)
-    script_tag = doc.new_tag("script")
-    script_tag.string = INJECT_JS
-    head.append(script_tag)
-
-    banner_div = doc.new_tag("div", **{"class": "mirage-banner"})
-    strong = doc.new_tag("strong")
-    strong.string = "You're viewing this page on Mirage, a privacy frontend to Miraheze licensed under GPL 3.0."
-    banner_div.append(strong)
-    banner_text = doc.new_tag("span")
-    banner_text.string = "All text content on Miraheze is licensed under Creative Commons licenses."
-    banner_div.append(banner_text)
-
-    container = doc.new_tag("div", **{"class": "mirage-container"})
-    container.append(banner_div)
-
-    content_fragment = BeautifulSoup(str(content_tag), "lxml")
-    content_only = content_fragment.find(id="content")
-    if not content_only:
-        return Response("Unexpected error extracting content.", status=500)
-
-    # rewrites and normalization
-    rewrite_links_in_tag(content_only, wiki_param, remote_sub, custom_host, remote_url)
-    normalize_images_in_tag(content_only, remote_sub, remote_url)
-
-    # galleries -> youtube -> templates/tables
-    reformat_galleries(content_only, remote_sub, remote_url)
-    detect_and_replace_youtube(content_only)
-    reformat_templates_and_tables(content_only)
+    transform_content(content_tag, wiki_param, remote_sub, custom_host, remote_url)
 
     if not categories:
-        categories = extract_categories_from_content(content_only, wiki_param, remote_sub, custom_host)
-
-    container.append(content_only)
+        categories = extract_categories_from_content(content_tag, wiki_param, remote_sub, custom_host)
 
+    parts = [_PAGE_START, serialize(content_tag)]
     if categories:
-        ul = doc.new_tag("ul", **{"class": "categories"})
+        parts.append('<ul class="categories">')
         for text, link in categories:
-            li = doc.new_tag("li")
-            a = doc.new_tag("a", href=link)
-            a.string = text
-            li.append(a)
-            ul.append(li)
-        container.append(ul)
+            parts.append("<li><a href=" + quote_attribute(link) + ">" + _escape(text) + "</a></li>")
+        parts.append("</ul>")
+    parts.append(_PAGE_END)
+    return "".join(parts)
+
+# Rendered pages are cached per version of the rendering, so a deploy that changes
+# it renders each page anew from the cached upstream copy instead of serving the old
+# rendering or going back to Miraheze. Bump _TRANSFORM_REVISION with every change to
+# the HTML pages come out as (tests/test_transform_golden.py shows them); changes to
+# the injected assets or MIRAGE_MEDIA_PROXY count without one.
+_TRANSFORM_REVISION = 1
+
+def _transform_version():
+    parts = [str(_TRANSFORM_REVISION), _PAGE_START, _PAGE_END, "media" if MEDIA_PROXY else ""]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:12]
+
+TRANSFORM_VERSION = _transform_version()
+
+# ---- title index (prefix search) ----
+# Each worker keeps the main-namespace titles of the wikis searched on it, sorted
+# case-insensitively, so /api/search answers a prefix with a bisect and no upstream
+# request. A wiki's index is built in the background from list=allpages the first time
+# it is searched (Special:AllPages answers until then) and kept current from recent
+# changes: pages created, deleted, restored and moved. The API requests for that are
+# paced by TITLE_INDEX_RATE, and a wiki whose index was just dropped to make room for
+# another isn't listed again until TITLE_INDEX_REFRESH has passed.
+_TITLE_INDEX_REBUILD = 7 * 24 * 3600  # list all titles again rather than replay this much of recent changes
+
+class TitleIndex:
+    """
+    A wiki's titles sorted by str.casefold(), current as of `since` (an API timestamp).
+    `titles` is None when there is no usable index: the wiki has more than
+    TITLE_INDEX_MAX titles (`since` set) or listing them failed. Never changed in place,
+    so searches need no lock while an update is made.
+    """
 
-    doc.body.append(container)
-    final_html = str(doc)
+    def __init__(self, titles, since):
+        self.titles = titles
+        self.since = since
+        self.checked = time.time()
+
+    def due(self):
+        age = time.time() - self.checked
+        if self.titles is None and self.since:
+            return age > _TITLE_INDEX_REBUILD  # too big; see whether it still is now and then
+        return age > TITLE_INDEX_REFRESH
+
+    def search(self, prefix, limit=100):
+        key = prefix.casefold()
+        titles = self.titles
+        found = []
+        i = bisect_left(titles, key, key=str.casefold)
+        while i < len(titles) and len(found) < limit and titles[i].casefold().startswith(key):
+            found.append(titles[i])
+            i += 1
+        return found
+
+    def updated(self, changes, since):
+        """A new index with the (added, title) changes applied in order."""
+        titles = list(self.titles)
+        for added, title in changes:
+            key = title.casefold()
+            i = j = bisect_left(titles, key, key=str.casefold)
+            while j < len(titles) and titles[j] != title and titles[j].casefold() == key:
+                j += 1
+            present = j < len(titles) and titles[j] == title
+            if added and not present:
+                titles.insert(i, title)
+            elif not added and present:
+                del titles[j]
+        return TitleIndex(titles, since)
+
+def _api_steps(remote_sub, params):
+    # upstream steps returning one API response; raise when there is none
+    url = (f"https://{remote_sub}.miraheze.org/w/api.php?"
+           + urlencode({"action": "query", "format": "json", "formatversion": "2", "curtimestamp": "1", **params}))
+    _title_index_throttle.wait()
+    r = yield UpstreamRequest(url, None)
+    if r.status_code != 200:
+        raise ValueError(f"API returned {r.status_code}")
+    data = r.json()
+    if "error" in data:
+        raise ValueError(f"API error {data['error'].get('code')}")
+    return data
 
-    # cache the generated HTML (best-effort; failures are non-fatal)
+def all_titles_steps(remote_sub):
+    """
+    Upstream steps returning (titles, timestamp): the wiki's main-namespace titles (None
+    past TITLE_INDEX_MAX) and the server time from before they were listed.
+    """
+    titles, since, cont = [], None, {}
+    while True:
+        data = yield from _api_steps(remote_sub, {"list": "allpages", "aplimit": "max", **cont})
+        since = since or data.get("curtimestamp")
+        titles.extend(page["title"] for page in data.get("query", {}).get("allpages", []))
+        if len(titles) > TITLE_INDEX_MAX:
+            return None, since
+        cont = data.get("continue")
+        if not cont:
+            return titles, since
+
+def _title_changes(rc):
+    # (added, title) pairs for one recent change
+    title = rc.get("title")
+    if rc.get("type") == "new":
+        return [(True, title)]
+    action, params = rc.get("logaction"), rc.get("logparams") or {}
+    if rc.get("logtype") == "delete":
+        if action == "restore":
+            return [(True, title)]
+        if action in ("delete", "delete_redir", "delete_redir2"):
+            return [(False, title)]
+    elif rc.get("logtype") == "move":
+        # the old title stays behind as a redirect unless that was suppressed
+        changes = [(False, title)] if params.get("suppressredirect") else []
+        if params.get("target_ns") == 0 and params.get("target_title"):
+            changes.append((True, params["target_title"]))
+        return changes
+    return []
+
+def title_changes_steps(remote_sub, since):
+    """
+    Upstream steps returning (changes, timestamp): the main-namespace titles added and
+    removed since `since`, oldest first, as (added, title) pairs.
+    """
+    params = {
+        "list": "recentchanges", "rcnamespace": "0", "rctype": "new|log", "rcprop": "title|loginfo",
+        "rcdir": "newer", "rcstart": since, "rclimit": "max",
+    }
+    changes, now, cont = [], None, {}
+    while True:
+        data = yield from _api_steps(remote_sub, {**params, **cont})
+        now = now or data.get("curtimestamp")
+        for rc in data.get("query", {}).get("recentchanges", []):
+            changes.extend(_title_changes(rc))
+        cont = data.get("continue")
+        if not cont:
+            return changes, now
+
+_title_indexes = OrderedDict()
+_title_indexes_dropped = OrderedDict()  # remote_sub -> when its index was dropped, oldest first
+_title_index_jobs = set()
+_title_index_lock = threading.Lock()
+_title_index_pool = None
+_title_index_throttle = RateLimit(TITLE_INDEX_RATE)
+
+def _update_title_index(remote_sub):
+    with _title_index_lock:
+        index = _title_indexes.get(remote_sub)
     try:
-        cache_set(cache_key, final_html)
+        if index is None or index.titles is None or (time.time() - index.checked) > _TITLE_INDEX_REBUILD:
+            titles, since = run_upstream(all_titles_steps(remote_sub))
+            index = TitleIndex(sorted(titles, key=str.casefold) if titles is not None else None, since)
+        else:
+            changes, since = run_upstream(title_changes_steps(remote_sub, index.since))
+            index = index.updated(changes, since or index.since)
     except Exception:
-        pass
+        # keep what we have (or nothing) and try again after TITLE_INDEX_REFRESH
+        index = TitleIndex(index.titles, index.since) if index is not None else TitleIndex(None, None)
+    now = time.time()
+    with _title_index_lock:
+        _title_indexes[remote_sub] = index
+        _title_indexes.move_to_end(remote_sub)
+        _title_indexes_dropped.pop(remote_sub, None)
+        while len(_title_indexes) > max(1, TITLE_INDEX_WIKIS):
+            _title_indexes_dropped[_title_indexes.popitem(last=False)[0]] = now
+        while _title_indexes_dropped and now - next(iter(_title_indexes_dropped.values())) > TITLE_INDEX_REFRESH:
+            _title_indexes_dropped.popitem(last=False)
+
+def _update_title_index_in_background(remote_sub):
+    # like _refresh_in_background(): one update per wiki at a time, and no more
+    # queued than there are indexes to keep
+    global _title_index_pool
+    with _title_index_lock:
+        if remote_sub in _title_index_jobs or len(_title_index_jobs) >= max(1, TITLE_INDEX_WIKIS):
+            return
+        if _title_index_pool is None:
+            _title_index_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mirage-titles")
+        _title_index_jobs.add(remote_sub)
+
+    def run():
+        try:
+            _update_title_index(remote_sub)
+        except Exception:
+            pass
+        finally:
+            with _title_index_lock:
+                _title_index_jobs.discard(remote_sub)
 
-    return Response(final_html, content_type="text/html; charset=utf-8")
+    try:
+        _title_index_pool.submit(run)
+    except Exception:
+        with _title_index_lock:
+            _title_index_jobs.discard(remote_sub)
+
+def title_search(wiki, q, limit=100):
+    """
+    Search results for the title prefix q from wiki's index, or None when there is no
+    index to answer from (yet). Builds and refreshes run in the background.
+    """
+    if TITLE_INDEX_MAX <= 0:
+        return None
+    remote_sub = derive_remote_subdomain(wiki)
+    with _title_index_lock:
+        index = _title_indexes.get(remote_sub)
+        if index is not None:
+            _title_indexes.move_to_end(remote_sub)
+        dropped = _title_indexes_dropped.get(remote_sub)
+    if index is not None:
+        wanted = index.due()
+    else:
+        # a wiki dropped a moment ago to make room waits before being listed again
+        wanted = dropped is None or time.time() - dropped > TITLE_INDEX_REFRESH
+    if wanted:
+        _update_title_index_in_background(remote_sub)
+    if index is None or index.titles is None:
+        return None
+    return [
+        {"title": title, "href": f"/{wiki}/wiki/{quote(title.replace(' ', '_'), safe='/')}"}
+        for title in index.search(q.replace("_", " "), limit)
+    ]
 
 # --- Routes ---
 
@@ -1289,6 +3667,33 @@ def fetch_and_transform(wiki_param, path, mode='wiki', qs=''):
 def index():
     return render_template("index.html")
 
+@app.route("/assets/<name>")
+def asset(name):
+    a = ASSETS.get(name)
+    if a is None:
+        return Response("Not found", status=404)
+    if request.accept_encodings["gzip"]:
+        resp = Response(a["gzip"], content_type=a["content_type"])
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(a["data"], content_type=a["content_type"])
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(a["etag"])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ASSET_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp.make_conditional(request)
+
+@app.route("/media/<host>/<path:path>")
+def media_proxy(host, path):
+    if host in ("wiki", "w"):
+        # pages of a wiki called "media"
+        return page_proxy("media", path) if host == "wiki" else w_proxy("media", path)
+    url = media_upstream_url(host, path, request.query_string.decode())
+    if url is None:
+        return Response("Not found", status=404)
+    return run_upstream(media_steps(url))
+
 @app.route("/<path:wiki>/wiki/<path:page>")
 def page_proxy(wiki, page):
     return fetch_and_transform(wiki, page, mode='wiki', qs='')
@@ -1305,6 +3710,13 @@ def api_search():
     q = (request.args.get('q') or '').strip()
     if not wiki or not q:
         return jsonify({"results": []})
+    results = title_search(wiki, q)
+    if results is None:
+        results = run_upstream(search_steps(wiki, q))
+    return jsonify({"results": results})
+
+def search_steps(wiki, q):
+    """Upstream steps returning the search results for q (a prefix) on wiki."""
     remote_sub = derive_remote_subdomain(wiki)
     try:
         fetch_path = quote(q, safe='')
@@ -1312,11 +3724,11 @@ def api_search():
         fetch_path = q
     remote_url = f"https://{remote_sub}.miraheze.org/wiki/Special:AllPages/{fetch_path}"
     try:
-        r = fetch_remote(remote_url)
+        r = yield UpstreamRequest(remote_url, None)
     except Exception:
-        return jsonify({"results": []})
+        return []
     if r.status_code != 200:
-        return jsonify({"results": []})
+        return []
     soup = BeautifulSoup(r.text, "lxml")
     content = soup.find(id="mw-content-text") or soup.find(id="content") or soup
     results = []
@@ -1338,7 +3750,41 @@ def api_search():
         results.append({"title": text, "href": proxied_href})
         if len(results) >= 100:
             break
-    return jsonify({"results": results})
+    return results
+
+# Cache statistics (counts only; no titles)
+@app.route('/api/stats')
+def api_stats():
+    try:
+        conn = _index()
+        entries, raw_entries = conn.execute("SELECT COUNT(*) - SUM(raw), SUM(raw) FROM entries").fetchone()
+        spellings, canonical = conn.execute("SELECT COUNT(*), COUNT(DISTINCT key_hash) FROM key_aliases").fetchone()
+        size = _index_total(conn)
+        raw_size = _raw_total(conn)
+        negatives = conn.execute("SELECT COUNT(*) FROM negative WHERE expires > ?", (time.time(),)).fetchone()[0]
+        custom_hosts = conn.execute("SELECT COUNT(*), COALESCE(SUM(seeded), 0) FROM custom_hosts").fetchone()
+        media_files = conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+        media_size = conn.execute("SELECT size FROM media_totals WHERE id = 0").fetchone()[0]
+    except Exception:
+        return jsonify({"error": "cache index unavailable"}), 503
+    with _title_index_lock:
+        indexed = [len(index.titles) for index in _title_indexes.values() if index.titles is not None]
+    return jsonify({
+        "cache": {"entries": entries or 0, "bytes": size, "max_bytes": MAX_CACHE_BYTES, "transform_version": TRANSFORM_VERSION},
+        "upstream_copies": {"entries": raw_entries or 0, "bytes": raw_size, "max_bytes": RAW_CACHE_MAX},
+        "media_cache": {"files": media_files, "bytes": media_size, "max_bytes": MEDIA_CACHE_MAX},
+        "negative_cache": {"entries": negatives, "max_entries": NEGATIVE_CACHE_MAX},
+        "custom_hosts": {"known": custom_hosts[0], "seeded": custom_hosts[1]},
+        "title_index": {"wikis": len(indexed), "titles": sum(indexed), "max_wikis": TITLE_INDEX_WIKIS},
+        "transform_pool": {"workers": max(0, TRANSFORM_WORKERS), "pending": _transform_pending, "max_pending": max(1, TRANSFORM_QUEUE)},
+        "key_normalization": {
+            "request_spellings": spellings,
+            "max_spellings": _KEY_ALIASES_MAX,
+            "canonical_keys": canonical,
+            # cache entries that would otherwise have been duplicates
+            "duplicate_keys_avoided": spellings - canonical,
+        },
+    })
 
 # /go redirect (main page form fallback)
 @app.route('/go', methods=['GET', 'POST'])
@@ -0,0 +1,333 @@
+"""
+ASGI entry point, for serving many slow upstream fetches from one process:
+
+    pip install httpx uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port 3000
+
+Pages (/<wiki>/wiki/..., /<wiki>/w/...), /media/ and /api/search are served on the
+event loop: their upstream fetches are awaited through httpx, while cache access and page
+transforms (the steps between fetches) run in a thread pool, or in the transform pool
+when MIRAGE_TRANSFORM_WORKERS is set. Every other route is the Flask app's, run in a
+thread. Without httpx installed all requests go to Flask that way.
+"""
+import asyncio
+import contextvars
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import requests
+from werkzeug.exceptions import HTTPException
+
+import app as mirage
+from app import CacheHit, Response, UpstreamRequest, jsonify, request
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+ASGI_THREADS = int(os.getenv("MIRAGE_ASGI_THREADS", "32"))  # threads for cache access, transforms and Flask routes
+
+flask_app = mirage.app
+_executor = ThreadPoolExecutor(max_workers=max(1, ASGI_THREADS), thread_name_prefix="mirage-asgi")
+_client = None
+
+def upstream_client():
+    """
+    Shared httpx.AsyncClient, set up like upstream_session(): keep-alive pools,
+    retried connects, no cookie jar. Redirects are followed as requests does.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers={"User-Agent": mirage.USER_AGENT},
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            timeout=httpx.Timeout(mirage.UPSTREAM_READ_TIMEOUT, connect=mirage.UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=mirage.UPSTREAM_POOL_HOSTS * mirage.UPSTREAM_POOL_SIZE,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=mirage.UPSTREAM_RETRIES),
+            follow_redirects=True,
+        )
+    return _client
+
+async def in_thread(func, *args):
+    # contextvars (the Flask request context) travel along, like with asyncio.to_thread()
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, ctx.run, func, *args)
+
+class ThreadedResponse:
+    """
+    An httpx response the way the upstream steps use a requests.Response from their
+    worker thread: text, json() and headers as usual, plus raw.stream() (reading through
+    the event loop) for a body left unread, and a close() that works either way.
+    """
+    def __init__(self, response, loop):
+        self.raw = self
+        self._response = response
+        self._loop = loop
+        self._chunks = None
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def stream(self, amt=None, decode_content=False):
+        # like urllib3's, a second stream() carries on where the first one stopped
+        if self._chunks is None:
+            self._chunks = self._response.aiter_raw(amt)
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                return
+
+    def close(self):
+        if self._response.is_closed:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._loop.create_task(self._response.aclose())
+        else:
+            asyncio.run_coroutine_threadsafe(self._response.aclose(), self._loop).result()
+
+async def fetch_upstream(step):
+    client = upstream_client()
+    r = await client.send(client.build_request("GET", step.url, headers=step.headers), stream=True)
+    if not step.stream or "text/html" in r.headers.get("Content-Type", ""):
+        await r.aread()
+    return ThreadedResponse(r, asyncio.get_running_loop())
+
+async def run_upstream(steps):
+    """run_upstream() for the event loop: fetches are awaited, the steps run in threads."""
+    step = await in_thread(mirage.advance_upstream, steps)
+    while isinstance(step, UpstreamRequest):
+        try:
+            r = await fetch_upstream(step)
+        except httpx.HTTPError as e:
+            error = requests.RequestException(str(e) or type(e).__name__)
+            step = await in_thread(mirage.advance_upstream, steps, None, error)
+        else:
+            step = await in_thread(mirage.advance_upstream, steps, r)
+    return step.value
+
+# ---- single flight ----
+# Same contract as app.single_flight(): one fetch per key at a time in this process
+# (waiters share its result) and, through the index's `flights` table, across workers.
+_flights = {}
+
+async def _lead_flight(key, steps):
+    owner = f"{os.getpid()}:task-{id(asyncio.current_task())}"
+    deadline = time.time() + mirage.SINGLE_FLIGHT_TIMEOUT
+    claimed = await in_thread(mirage._claim_flight, key, owner)
+    while not claimed:
+        # another worker is fetching this page; wait for it to land in the cache
+        await asyncio.sleep(0.05)
+        hit = await in_thread(mirage.cache_lookup, key)
+        if hit is not None:
+            return hit
+        if time.time() >= deadline:
+            break
+        claimed = await in_thread(mirage._claim_flight, key, owner)
+    try:
+        if claimed:
+            # the previous leader may have finished between our cache check and claim
+            hit = await in_thread(mirage.cache_lookup, key)
+            if hit is not None:
+                return hit
+        return await run_upstream(steps())
+    finally:
+        if claimed:
+            await in_thread(mirage._release_flight, key, owner)
+
+async def single_flight(key, steps):
+    flight = _flights.get(key)
+    if flight is not None:
+        try:
+            shared = await asyncio.wait_for(asyncio.shield(flight), mirage.SINGLE_FLIGHT_TIMEOUT)
+        except asyncio.TimeoutError:
+            shared = None
+        if isinstance(shared, CacheHit):
+            return shared
+        if shared is not None:
+            body, status, headers = shared
+            return Response(body, status=status, headers=headers)
+        # leader timed out or failed -> do the work ourselves
+        return await run_upstream(steps())
+    flight = _flights[key] = asyncio.get_running_loop().create_future()
+    shared = None
+    try:
+        result = await _lead_flight(key, steps)
+        if isinstance(result, CacheHit):
+            shared = result
+        elif not result.is_streamed:
+            shared = (result.get_data(), result.status_code, list(result.headers.items()))
+        return result
+    finally:
+        _flights.pop(key, None)
+        flight.set_result(shared)
+
+# ---- routes served on the event loop ----
+async def serve_page(send, wiki, path, mode, qs):
+    """fetch_and_transform() with awaited upstream fetches."""
+    looked_up = await in_thread(mirage.lookup_page, wiki, path, mode, qs)
+    if isinstance(looked_up, Response):
+        return looked_up
+    cache_key, steps, hit = looked_up
+
+    if (mirage.EARLY_FLUSH and mode == 'wiki' and mirage._wants_early_flush()
+            and await in_thread(mirage.negative_get, cache_key) is None):
+        # see early_flush_response()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/html; charset=utf-8"), (b"x-accel-buffering", b"no")],
+        })
+        await send({"type": "http.response.body", "body": mirage._PAGE_START.encode("utf-8"), "more_body": True})
+        try:
+            result = mirage._page_or_stale(await single_flight(cache_key, steps), hit)
+        except Exception:
+            result = Response("Error rendering the page.", status=500)
+        remainder = await in_thread(mirage._page_remainder, result)
+        await send({"type": "http.response.body", "body": remainder.encode("utf-8") if isinstance(remainder, str) else remainder})
+        return None
+
+    result = mirage._page_or_stale(await single_flight(cache_key, steps), hit)
+    if isinstance(result, CacheHit):
+        return await in_thread(mirage.cached_response, result)
+    return result
+
+async def page_proxy(send, wiki, page):
+    return await serve_page(send, wiki, page, 'wiki', '')
+
+async def w_proxy(send, wiki, rest):
+    return await serve_page(send, wiki, rest, 'w', request.query_string.decode() or "")
+
+async def media_proxy(send, host, path):
+    if host in ("wiki", "w"):
+        return await (page_proxy if host == "wiki" else w_proxy)(send, "media", path)
+    url = mirage.media_upstream_url(host, path, request.query_string.decode())
+    if url is None:
+        return Response("Not found", status=404)
+    return await run_upstream(mirage.media_steps(url))
+
+async def api_search(send):
+    wiki = (request.args.get('wiki') or '').strip()
+    q = (request.args.get('q') or '').strip()
+    if not wiki or not q:
+        return jsonify({"results": []})
+    results = await in_thread(mirage.title_search, wiki, q)
+    if results is None:
+        results = await run_upstream(mirage.search_steps(wiki, q))
+    return jsonify({"results": results})
+
+# Flask endpoint -> handler taking send and the view arguments; returns the Response
+# to send, or None when it sent one itself
+_ROUTES = {"page_proxy": page_proxy, "w_proxy": w_proxy, "media_proxy": media_proxy, "api_search": api_search}
+
+# ---- ASGI <-> WSGI plumbing ----
+def wsgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 80)
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+async def send_wsgi(send, wsgi_app, environ):
+    """Send what a WSGI app (Flask, or a Response) answers, a chunk at a time."""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+
+    chunks = await in_thread(wsgi_app, environ, start_response)
+    try:
+        chunk_iter = iter(chunks)
+        chunk = await in_thread(next, chunk_iter, None)
+        status, headers = started
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+        })
+        while chunk is not None:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await in_thread(next, chunk_iter, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(chunks, "close"):
+            await in_thread(chunks.close)
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return body
+
+async def lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    environ = wsgi_environ(scope, await read_body(receive))
+    handler = None
+    if httpx is not None:
+        try:
+            endpoint, args = flask_app.url_map.bind_to_environ(environ).match()
+            handler = _ROUTES.get(endpoint)
+        except HTTPException:
+            pass  # 404s, 405s and slash redirects are Flask's to answer
+    if handler is None:
+        return await send_wsgi(send, flask_app, environ)
+    with flask_app.request_context(environ):
+        try:
+            resp = await handler(send, **args)
+        except Exception:
+            flask_app.logger.exception("Exception on %s [%s]", environ["PATH_INFO"], environ["REQUEST_METHOD"])
+            resp = Response("Internal Server Error", status=500)
+    if resp is not None:
+        await send_wsgi(send, resp, environ)
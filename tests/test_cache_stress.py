@@ -0,0 +1,106 @@
+"""
+Stress test for the shared file cache: several processes read and write one
+CACHE_DIR at once, as gunicorn workers do, and the byte budget must hold at
+every moment.
+
+    python -m pytest tests/test_cache_stress.py
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BUDGET = 256 * 1024
+PROCESSES = 6
+OPERATIONS = 300
+
+# one worker: random writes (some replacing bigger or smaller entries), lookups and deletes
+WORKER = """
+import os, random, sys
+import app
+
+rnd = random.Random(int(sys.argv[1]))
+for _ in range(int(sys.argv[2])):
+    key = f"stress|{rnd.randrange(200)}"
+    roll = rnd.random()
+    if roll < 0.6:
+        # random hex compresses to about half: entries of 1-24KB on disk
+        app.cache_set(key, os.urandom(rnd.randrange(1000, 24000)).hex(),
+                      mtime=app.time.time() - rnd.randrange(3600) if roll < 0.1 else None)
+    elif roll < 0.95:
+        app.cache_lookup(key)
+    else:
+        app.cache_delete(key)
+"""
+
+def _env(cache_dir):
+    env = dict(os.environ)
+    env.update({
+        "MIRAGE_CACHE_DIR": str(cache_dir),
+        "MIRAGE_CACHE_MAX": str(BUDGET),
+        "MIRAGE_MEMCACHE_MAX": "0",
+        "MIRAGE_CACHE_CODEC": "gzip:1",
+        "PYTHONPATH": str(ROOT) + os.pathsep + env.get("PYTHONPATH", ""),
+    })
+    return env
+
+def _snapshot(cache_dir):
+    """
+    (bytes of cache files on disk, indexed total), taken under the index write
+    lock so no worker is halfway through replacing or evicting a file.
+    """
+    conn = sqlite3.connect(cache_dir / "index.sqlite3", timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            on_disk = sum(p.stat().st_size for p in cache_dir.glob("*.bin"))
+            indexed = conn.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+        finally:
+            conn.execute("ROLLBACK")
+    finally:
+        conn.close()
+    return on_disk, indexed
+
+def _start_workers(cache_dir, count, operations):
+    return [
+        subprocess.Popen([sys.executable, "-c", WORKER, str(seed), str(operations)],
+                         cwd=ROOT, env=_env(cache_dir), stderr=subprocess.PIPE)
+        for seed in range(count)
+    ]
+
+def test_budget_holds_under_concurrent_writers(tmp_path):
+    # create the index first so the workers don't race to build it
+    subprocess.run([sys.executable, "-c", "import app; app._index()"],
+                   cwd=ROOT, env=_env(tmp_path), check=True)
+    workers = _start_workers(tmp_path, PROCESSES, OPERATIONS)
+    snapshots = 0
+    peak = 0
+    while any(w.poll() is None for w in workers):
+        on_disk, indexed = _snapshot(tmp_path)
+        assert on_disk <= BUDGET, f"{on_disk} bytes of cache files, budget {BUDGET}"
+        assert on_disk == indexed, f"{on_disk} bytes on disk but {indexed} indexed"
+        peak = max(peak, on_disk)
+        snapshots += 1
+        time.sleep(0.005)
+    for w in workers:
+        assert w.wait() == 0, w.stderr.read().decode()
+    on_disk, indexed = _snapshot(tmp_path)
+    assert on_disk <= BUDGET and on_disk == indexed
+    assert snapshots > 0
+    assert peak > BUDGET // 2, "the workers never filled the cache, so the budget wasn't tested"
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_stale_temp_files_are_swept(tmp_path):
+    stale = tmp_path / "0123.bin.abcd.tmp"
+    fresh = tmp_path / "4567.bin.efgh.tmp"
+    stale.write_bytes(b"x" * 1000)
+    fresh.write_bytes(b"x" * 1000)
+    two_hours_ago = time.time() - 2 * 3600
+    os.utime(stale, (two_hours_ago, two_hours_ago))
+    subprocess.run([sys.executable, "-c", "import app; app._index()"],
+                   cwd=ROOT, env=_env(tmp_path), check=True)
+    assert not stale.exists()
+    assert fresh.exists()  # may belong to a worker still waiting for the index lock
@@ -0,0 +1,65 @@
+"""
+The cookie-notice pass looks at the text of every element, which done naively
+costs depth x text on deeply nested pages (navboxes inside navboxes), and walks
+every element, which lxml can make cost depth each too. Check that it grows
+linearly with nesting depth instead.
+
+    python -m pytest tests/test_cookie_scaling.py
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault("MIRAGE_CACHE_DIR", tempfile.mkdtemp(prefix="mirage-scaling-"))
+sys.path.insert(0, str(ROOT))
+import app  # noqa: E402
+
+SHALLOW = 2000
+DEEP = 16000  # 8x deeper: about 8x the time if linear, 64x if quadratic
+
+def _nested(depth, text="lorem ipsum dolor sit amet "):
+    # built directly: the HTML parser stops nesting at 256 levels (and, like the pass
+    # under test, holding on to every element keeps lxml from walking up the tree)
+    root = app.etree.Element("html")
+    chain = [app.etree.SubElement(app.etree.SubElement(root, "body"), "div", id="content")]
+    for _ in range(depth):
+        chain.append(app.etree.SubElement(chain[-1], "div", {"class": "x"}))
+        chain[-1].text = text
+    return root
+
+def _best_time(func, depth, runs=5):
+    # nothing in these trees is removed, so one serves every run
+    root = _nested(depth)
+    best = float("inf")
+    for _ in range(runs):
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(root)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+def test_short_texts_scale_linearly_with_depth():
+    shallow = _best_time(app._short_texts, SHALLOW)
+    deep = _best_time(app._short_texts, DEEP)
+    assert deep < shallow * (DEEP / SHALLOW) * 3, f"{SHALLOW} levels {shallow:.4f}s, {DEEP} levels {deep:.4f}s"
+
+def test_cookie_pass_scales_linearly_with_depth():
+    shallow = _best_time(app.remove_unwanted_global, SHALLOW)
+    deep = _best_time(app.remove_unwanted_global, DEEP)
+    assert deep < shallow * (DEEP / SHALLOW) * 3, f"{SHALLOW} levels {shallow:.4f}s, {DEEP} levels {deep:.4f}s"
+
+def test_short_texts_match_the_element_text():
+    root = app.parse_html(
+        "<html><body><div id='banner'><p>We use <b>cookies</b>.</p> <button>Accept</button></div>"
+        "<div id='long'>" + "word " * 300 + "</div></body></html>")
+    texts = app._short_texts(root)
+    banner = root.xpath('//*[@id="banner"]')[0]
+    assert texts[banner] == "we use cookies . accept"
+    assert root.xpath('//*[@id="long"]')[0] not in texts
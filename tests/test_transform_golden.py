@@ -0,0 +1,64 @@
+"""
+Golden tests for the page transform: upstream pages in tests/fixtures/pages are
+rendered and compared byte for byte with the .expected.html file next to them, so
+a change to the rendered HTML shows up as a diff here (and calls for bumping
+_TRANSFORM_REVISION in app.py) rather than in readers' browsers.
+
+    python -m pytest tests/test_transform_golden.py
+
+After an intended change, rewrite the expected files and review their diff:
+
+    MIRAGE_UPDATE_GOLDEN=1 python -m pytest tests/test_transform_golden.py
+"""
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+PAGES = Path(__file__).resolve().parent / "fixtures" / "pages"
+
+# the rendering depends on these; pin them whatever the environment says
+os.environ["MIRAGE_MEDIA_PROXY"] = "1"
+os.environ.setdefault("MIRAGE_CACHE_DIR", tempfile.mkdtemp(prefix="mirage-golden-"))
+sys.path.insert(0, str(ROOT))
+import app  # noqa: E402
+
+def _scraped(name, wiki_param, remote_sub, title):
+    text = (PAGES / f"{name}.html").read_text(encoding="utf-8")
+    remote_url = f"https://{remote_sub}.miraheze.org/wiki/{title}"
+    return app.transform_scraped_page(text, wiki_param, remote_sub, remote_url)[1]
+
+def _parsed(name, wiki_param, remote_sub, title):
+    parsed = json.loads((PAGES / f"{name}.json").read_text(encoding="utf-8"))["parse"]
+    categories = app.parsed_page_categories(parsed, remote_sub, None)
+    remote_url = f"https://{remote_sub}.miraheze.org/wiki/{title}"
+    return app.transform_parsed_page(parsed, wiki_param, remote_sub, None, remote_url, categories)
+
+CASES = {
+    # skinned Vector page: infobox, thumbs, gallery, embeds, references, navbox, categories
+    "article": lambda: _scraped("article", "coastal", "coastal", "Lighthouse"),
+    # Citizen page of a wiki on its own domain, requested under that domain
+    "custom_domain": lambda: _scraped("custom_domain", "wiki.example.net", "examplewiki", "Tide_tables"),
+    # action=parse result with a hidden category
+    "harbour": lambda: _parsed("harbour", "coastal", "coastal", "Harbour"),
+}
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_rendering_matches_golden(name):
+    rendered = CASES[name]().encode("utf-8")
+    expected_path = PAGES / f"{name}.expected.html"
+    if os.getenv("MIRAGE_UPDATE_GOLDEN"):
+        expected_path.write_bytes(rendered)
+    assert rendered == expected_path.read_bytes()
+
+def test_bare_subdomain_with_custom_domain_is_not_rendered():
+    # the reader gets redirected to the custom domain, so no HTML is made
+    text = (PAGES / "custom_domain.html").read_text(encoding="utf-8")
+    custom_host, final_html = app.transform_scraped_page(
+        text, "examplewiki", "examplewiki", "https://examplewiki.miraheze.org/wiki/Tide_tables")
+    assert custom_host == "wiki.example.net"
+    assert final_html is None
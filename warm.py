@@ -0,0 +1,215 @@
+"""
+Cache warming: render a wiki's pages into the cache before its readers ask for them.
+
+    python warm.py <wiki> [--source allpages|mostviewed|titles] [--titles FILE]
+                          [--limit N] [--concurrency 4] [--rate 2] [--restart]
+
+Pages are listed through the MediaWiki API (list=allpages; list=mostviewed, or the
+most linked-to pages on wikis without page view counts) or read from a file with one
+title per line, and run through the same lookup, single flight and rendering as a
+reader's request, so they land in the cache exactly as readers get them. Pages still
+fresh in the cache cost nothing; the rest are fetched at most --concurrency at a time
+and started no faster than --rate per second.
+
+Progress is kept in CACHE_DIR/warm-<wiki>.state as hashes of the finished titles (the
+cache keeps no titles either): an interrupted run carries on where it stopped, and a
+finished one removes the file. Run it with the server's environment, e.g.
+
+    docker compose exec mirage python warm.py <wiki>
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from urllib.parse import quote, urlencode
+
+import app as mirage
+from app import CacheHit, Response
+
+flask_app = mirage.app
+
+# ---- page lists ----
+def api_query(remote_sub, params):
+    """Yield the `query` part of each batch of API results, following continuation."""
+    params = {"action": "query", "format": "json", "formatversion": "2", **params}
+    cont = {}
+    while True:
+        r = mirage.fetch_remote(f"https://{remote_sub}.miraheze.org/w/api.php?" + urlencode({**params, **cont}))
+        r.raise_for_status()
+        data = r.json()
+        if "error" in data:
+            raise RuntimeError(data["error"].get("info") or data["error"].get("code"))
+        yield data.get("query", {})
+        cont = data.get("continue")
+        if not cont:
+            return
+
+def allpages(remote_sub):
+    for query in api_query(remote_sub, {"list": "allpages", "apfilterredir": "nonredirects", "aplimit": "max"}):
+        for page in query.get("allpages", []):
+            yield page["title"]
+
+def mostviewed(remote_sub):
+    found = False
+    for query in api_query(remote_sub, {"list": "mostviewed", "pvimlimit": "max"}):
+        if "mostviewed" not in query:
+            break  # only a warning: the PageViewInfo extension isn't installed
+        found = True
+        for page in query["mostviewed"]:
+            if page.get("ns") == 0:
+                yield page["title"]
+    if found:
+        return
+    # no view counts on this wiki -> the pages most linked to
+    for query in api_query(remote_sub, {"list": "querypage", "qppage": "Mostlinked", "qplimit": "max"}):
+        for page in (query.get("querypage") or {}).get("results", []):
+            if page.get("ns") == 0:
+                yield page["title"]
+
+def titles_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            title = line.strip()
+            if title and not title.startswith("#"):
+                yield title
+
+# ---- warming ----
+def _warm(wiki, path, throttle):
+    with flask_app.test_request_context(f"/{wiki}/wiki/{quote(path, safe=mirage._TITLE_URL_SAFE)}"):
+        looked_up = mirage.lookup_page(wiki, path, background=False)
+        if isinstance(looked_up, Response):
+            looked_up.close()
+            return "cached" if looked_up.status_code == 200 else "redirected"
+        cache_key, steps, _hit = looked_up
+        throttle.wait()
+        result = mirage.single_flight(cache_key, lambda: mirage.run_upstream(steps()))
+        if isinstance(result, CacheHit):
+            return "fetched"
+        result.close()
+        return "redirected" if 300 <= result.status_code < 400 else "failed"
+
+def warm_page(wiki, title, throttle):
+    """
+    Put one page in the cache; returns "cached" (was fresh already), "fetched",
+    "redirected" or "failed".
+    """
+    path = title.replace(" ", "_")
+    try:
+        outcome = _warm(wiki, path, throttle)
+        if outcome == "redirected" and "." not in wiki:
+            # the wiki has a domain of its own, learned from this page
+            host = mirage.custom_host_for(wiki)
+            if host:
+                outcome = _warm(host, path, throttle)
+        return outcome
+    except Exception:
+        return "failed"
+
+def _state_path(wiki):
+    return os.path.join(mirage.CACHE_DIR, "warm-" + re.sub(r"[^A-Za-z0-9.-]", "_", wiki) + ".state")
+
+def _title_hash(title):
+    return hashlib.sha256(title.encode("utf-8")).hexdigest()[:32]
+
+def _load_state(path):
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def _report(counts, done, total, started):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    parts = ", ".join(f"{name} {counts[name]}" for name in ("cached", "fetched", "redirected", "failed") if counts[name])
+    print(f"{done}/{total} pages ({parts or 'none yet'}), {done / elapsed:.1f}/s", file=sys.stderr, flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the Mirage cache with a wiki's pages.")
+    parser.add_argument("wiki", help="wiki as in Mirage URLs: Miraheze subdomain or custom domain")
+    parser.add_argument("--source", choices=("allpages", "mostviewed", "titles"), default="allpages")
+    parser.add_argument("--titles", metavar="FILE", help="file with one title per line (--source titles)")
+    parser.add_argument("--limit", type=int, default=0, help="warm at most this many pages (0 = all)")
+    parser.add_argument("--concurrency", type=int, default=4, help="pages fetched at once")
+    parser.add_argument("--rate", type=float, default=2.0, help="upstream fetches started per second (0 = no limit)")
+    parser.add_argument("--progress", type=float, default=10.0, help="seconds between progress lines")
+    parser.add_argument("--restart", action="store_true", help="ignore the progress of an earlier, interrupted run")
+    args = parser.parse_args(argv)
+    if args.source == "titles" and not args.titles:
+        parser.error("--source titles needs --titles FILE")
+
+    wiki = args.wiki.strip().strip("/")
+    if "." not in wiki and mirage.custom_host_for(wiki):
+        wiki = mirage.custom_host_for(wiki)
+    remote_sub = mirage.derive_remote_subdomain(wiki)
+    try:
+        if args.source == "titles":
+            listed = titles_file(args.titles)
+        elif args.source == "mostviewed":
+            listed = mostviewed(remote_sub)
+        else:
+            listed = allpages(remote_sub)
+        titles = list(dict.fromkeys(itertools.islice(listed, args.limit or None)))
+    except Exception as e:
+        print(f"Could not list the pages of {wiki}: {e}", file=sys.stderr)
+        return 1
+
+    state_path = _state_path(wiki)
+    if args.restart:
+        try:
+            os.remove(state_path)
+        except FileNotFoundError:
+            pass
+    finished = _load_state(state_path)
+    todo = [title for title in titles if _title_hash(title) not in finished]
+    print(f"{wiki}: {len(titles)} pages listed, {len(titles) - len(todo)} done in an earlier run", file=sys.stderr, flush=True)
+
+    Path(mirage.CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    throttle = mirage.RateLimit(args.rate)
+    counts = dict.fromkeys(("cached", "fetched", "redirected", "failed"), 0)
+    started = last_report = time.monotonic()
+    done = 0
+    pending = {}
+    queue = iter(todo)
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="mirage-warm")
+    try:
+        with open(state_path, "a", encoding="ascii") as state:
+            while True:
+                while len(pending) < 2 * max(1, args.concurrency):
+                    title = next(queue, None)
+                    if title is None:
+                        break
+                    pending[executor.submit(warm_page, wiki, title, throttle)] = title
+                if not pending:
+                    break
+                finished_now, _ = wait(pending, timeout=args.progress, return_when=FIRST_COMPLETED)
+                for future in finished_now:
+                    title = pending.pop(future)
+                    outcome = future.result()
+                    counts[outcome] += 1
+                    done += 1
+                    if outcome != "failed":
+                        state.write(_title_hash(title) + "\n")
+                state.flush()
+                if time.monotonic() - last_report >= args.progress:
+                    _report(counts, done, len(todo), started)
+                    last_report = time.monotonic()
+    except KeyboardInterrupt:
+        executor.shutdown(wait=True, cancel_futures=True)
+        _report(counts, done, len(todo), started)
+        print("Interrupted; run again to carry on.", file=sys.stderr)
+        return 130
+    executor.shutdown(wait=True)
+    _report(counts, done, len(todo), started)
+    try:
+        os.remove(state_path)
+    except FileNotFoundError:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())